@@ -0,0 +1,138 @@
+"""
+リクエストの受付制御 (アドミッションコントロール)
+
+書き込みが詰まると /insert は SQLite のロック待ちのままタイムアウトまで粘り、
+その間にダッシュボードの読み込みまで遅くなる。
+ここでは「同時に処理する数」「待たせておける数」「待ち時間の上限」を決めた
+ゲートをルートの前に置き、あふれた分はすぐに 503 + Retry-After で断る。
+書き込み用と読み込み用でゲートを分けることで、書き込みが混んでいても
+読み込みの枠は食いつぶされない。
+"""
+import functools
+import math
+import threading
+import time
+
+from flask import jsonify, request
+
+
+class AdmissionGate:
+    """
+    同時実行数・待ち行列の長さ・待ち時間の上限を持つゲート
+    - max_concurrent: 同時に処理するリクエスト数
+    - max_queue: 空きを待たせておけるリクエスト数 (超えたら即座に断る)
+    - timeout: 空きを待つ最大秒数 (超えたら断る)
+    """
+
+    def __init__(self, name, max_concurrent, max_queue, timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        # 計測値
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.max_waiting_seen = 0
+        self._wait_time_total = 0.0
+        self._service_time_total = 0.0
+        self._completed = 0
+
+    def acquire(self):
+        """処理枠を取る。取れなければ False (呼び出し側で 503 を返す)"""
+        start = time.monotonic()
+        with self._cond:
+            if self.in_flight < self.max_concurrent and self.waiting == 0:
+                self.in_flight += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected_queue_full += 1
+                return False
+
+            self.waiting += 1
+            self.max_waiting_seen = max(self.max_waiting_seen, self.waiting)
+            deadline = start + self.timeout
+            try:
+                while self.in_flight >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_timeout += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self.in_flight += 1
+            self.admitted += 1
+            self._wait_time_total += time.monotonic() - start
+            return True
+
+    def release(self, service_time):
+        """処理枠を返す"""
+        with self._cond:
+            self.in_flight -= 1
+            self._completed += 1
+            self._service_time_total += service_time
+            self._cond.notify()
+
+    def retry_after(self):
+        """
+        再試行までの目安 (秒) を返す
+        今の待ち行列が捌けるまでの時間を平均処理時間から見積もる (最低1秒)
+        """
+        with self._cond:
+            avg = self._service_time_total / self._completed if self._completed else 0
+            backlog = self.waiting + self.in_flight
+        return max(1, math.ceil(avg * backlog / self.max_concurrent))
+
+    def snapshot(self):
+        """現在の状態と累計値を返す (メトリクス用)"""
+        with self._cond:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'timeout': self.timeout,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'max_waiting_seen': self.max_waiting_seen,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_timeout': self.rejected_timeout,
+                'avg_wait_ms': 1000 * self._wait_time_total / self.admitted if self.admitted else 0,
+                'avg_service_ms': 1000 * self._service_time_total / self._completed if self._completed else 0,
+            }
+
+
+def overloaded_response(gate):
+    """混雑時の 503 レスポンス (API は JSON、画面はテキスト)"""
+    retry_after = gate.retry_after()
+    if request.path.startswith('/api/'):
+        response = jsonify({'error': 'server busy', 'retry_after': retry_after})
+    else:
+        response = "混雑しています。しばらくしてから再度お試しください。"
+    return response, 503, {'Retry-After': str(retry_after)}
+
+
+def admission_required(gate, methods=None):
+    """
+    ルートをゲートの内側で実行するデコレータ
+    methods を指定するとそのメソッドのときだけ制御する (例: 書き込みは POST のみ)
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if methods is not None and request.method not in methods:
+                return view(*args, **kwargs)
+            if not gate.acquire():
+                return overloaded_response(gate)
+            start = time.monotonic()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                gate.release(time.monotonic() - start)
+        return wrapper
+    return decorator
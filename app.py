@@ -21,6 +21,9 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # SQLAlchemy（データベース操作ライブラリ：ORM）の初期化
 db = SQLAlchemy(app)
 
+# 1ページに表示するタスクの数
+TODO_PAGE_SIZE = 50
+
 # --- データベースモデルの定義（テーブル設計） ---
 
 # Todoテーブルに対応するPythonのクラス
@@ -62,11 +65,22 @@ def index():
 
     else:
         # --- GETリクエスト（ページ表示）時の処理 ---
-        # データベースから全てのTodo（タスク）を取得
-        # .all() ですべての行を取得
-        todos = Todo.query.all()
-        # 'index.html' テンプレートを読み込み、取得した 'todos' を渡して表示
-        return render_template('index.html', todos=todos)
+        # データベースからTodo（タスク）を1ページ分だけ取得
+        # '?after=<id>' が指定されたら、そのIDより後ろのタスクから読む（キーセット方式）
+        # OFFSETと違い、何ページ目でも主キーのインデックスで直接たどれるので速さが変わらない
+        after_id = request.args.get('after', type=int)
+        query = Todo.query.order_by(Todo.id)
+        if after_id is not None:
+            query = query.filter(Todo.id > after_id)
+        # 1件多めに取得して、次のページがあるかどうかを判定する
+        todos = query.limit(TODO_PAGE_SIZE + 1).all()
+        next_after = None
+        if len(todos) > TODO_PAGE_SIZE:
+            todos = todos[:TODO_PAGE_SIZE]
+            next_after = todos[-1].id
+        # 'todo.html' テンプレートを読み込み、取得した 'todos' と次ページの開始位置を渡して表示
+        # （'index.html' は家計簿のダッシュボードなので、Todo一覧は専用のテンプレートに分ける）
+        return render_template('todo.html', todos=todos, next_after=next_after)
 
 # --- アプリケーションの実行 ---
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+"""
+起動時間のベンチマーク
+
+ワーカーを新しく起動したときの「起動処理 (import + create_app)」と
+「最初のリクエスト群 (全ページを1回ずつ表示)」にかかる時間を、
+テンプレートのバイトコードキャッシュ・事前ウォームアップの有無で比べる。
+あわせて、起動時のスキーマ確認を PRAGMA user_version で判定する今の方法と、
+以前の sqlite_master を調べる方法 (後から追加したテーブルも毎回調べて作成を試みる) で比べる。
+
+    python bench/startup.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行するコード (起動から最初のリクエストまでを計測する)
+CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import server
+app = server.create_app(prewarm_caches=(sys.argv[1] == '1'))
+t1 = time.perf_counter()
+client = app.test_client()
+with client.session_transaction() as s:
+    s['user_id'] = 1
+    s['username'] = 'bench'
+for path in ('/', '/insert', '/history', '/otaku'):
+    client.get(path)
+guest = app.test_client()
+guest.get('/login')
+guest.get('/signup')
+t2 = time.perf_counter()
+print(json.dumps({'startup': t1 - t0, 'first_requests': t2 - t1}))
+"""
+
+
+def run_child(env, prewarm):
+    out = subprocess.run(
+        [sys.executable, '-c', CHILD, '1' if prewarm else '0'],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def sqlite_master_probe(conn):
+    """バージョン管理前の確認方法: users の有無を sqlite_master で調べ、後から追加したテーブルも毎回確認する"""
+    from db import upgrade_schema
+
+    conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'").fetchone()
+    upgrade_schema(conn)
+    conn.commit()
+
+
+def bench_schema_check(db_path, runs):
+    """接続を開いてスキーマを確認し閉じるまでの時間 (ms, 中央値) を、2つの方法で測る"""
+    sys.path.insert(0, ROOT)
+    from db import ensure_schema
+    from db.storage import connect
+
+    schema_path = os.path.join(ROOT, 'db', 'schema.sql')
+    methods = [
+        ("sqlite_master の確認 (従来)", sqlite_master_probe),
+        ("PRAGMA user_version", lambda conn: ensure_schema(conn, schema_path)),
+    ]
+    results = []
+    for label, check in methods:
+        times = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            conn = connect(db_path)
+            check(conn)
+            conn.close()
+            times.append((time.perf_counter() - t0) * 1000)
+        results.append((label, statistics.median(times)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    env = dict(os.environ,
+               OSHI_DATABASE=os.path.join(work, 'bench.db'),
+               OSHI_JINJA_CACHE_DIR=os.path.join(work, 'jinja_cache'))
+    # DBは先に作っておく (2回目以降の起動を想定する)
+    run_child(env, prewarm=False)
+
+    scenarios = [
+        ("キャッシュなし", False, True),
+        ("バイトコードキャッシュあり", False, False),
+        ("キャッシュあり + 事前ウォームアップ", True, False),
+    ]
+    print(f"{'条件':<36} {'起動(ms)':>10} {'初回リクエスト(ms)':>18} {'合計(ms)':>10}")
+    try:
+        for label, prewarm, clear_cache in scenarios:
+            startups, firsts = [], []
+            for _ in range(args.runs):
+                if clear_cache:
+                    shutil.rmtree(env['OSHI_JINJA_CACHE_DIR'], ignore_errors=True)
+                result = run_child(env, prewarm)
+                startups.append(result['startup'] * 1000)
+                firsts.append(result['first_requests'] * 1000)
+            s, f = statistics.median(startups), statistics.median(firsts)
+            print(f"{label:<36} {s:>10.1f} {f:>18.1f} {s + f:>10.1f}")
+
+        print()
+        print(f"{'スキーマ確認 (DBファイル1つあたり)':<36} {'時間(ms)':>10}")
+        for label, ms in bench_schema_check(env['OSHI_DATABASE'], args.runs * 20):
+            print(f"{label:<36} {ms:>10.3f}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+ストレージプロファイルごとの読み書き性能の比較
+
+各プロファイルで新しいDBを作り、
+- 書き込み: 購入1件の追加 + 集計更新を1件ずつコミット
+- 読み込み: 履歴の1ページ目と当月の月次集計の取得
+をそれぞれ繰り返して、1秒あたりの件数を出す。
+
+    python bench/storage.py [--writes 500] [--reads 5000] [--users 20]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import ensure_schema  # noqa: E402
+from db.purchase import insert_purchase, fetch_purchase_page  # noqa: E402
+from db.summary import refresh_summaries  # noqa: E402
+from db.storage import PROFILES, connect  # noqa: E402
+
+
+def bench_profile(profile, work_dir, writes, reads, users):
+    path = os.path.join(work_dir, f"{profile}.db")
+    conn = connect(path, profile)
+    ensure_schema(conn)
+    conn.executemany(
+        "INSERT INTO users (username, password_hash) VALUES (?, 'x')",
+        [(f"bench{i}",) for i in range(users)]
+    )
+    conn.commit()
+    rng = random.Random(0)
+
+    start = time.perf_counter()
+    for _ in range(writes):
+        user_id = rng.randint(1, users)
+        date_str = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        amounts = {'drink': rng.randint(100, 1000), 'snack': 0, 'main': 0, 'irregular': 0}
+        insert_purchase(conn, user_id, date_str, '朝', amounts)
+        refresh_summaries(conn, user_id, date_str)
+        conn.commit()
+    write_elapsed = time.perf_counter() - start
+    conn.close()
+
+    conn = connect(path, profile, read_only=True)
+    start = time.perf_counter()
+    for _ in range(reads):
+        user_id = rng.randint(1, users)
+        fetch_purchase_page(conn, user_id)
+        conn.execute(
+            "SELECT * FROM monthly_summaries WHERE user_id = ? AND year = ? AND month = ?",
+            (user_id, 2025, rng.randint(1, 12))
+        ).fetchone()
+    read_elapsed = time.perf_counter() - start
+    conn.close()
+    return writes / write_elapsed, reads / read_elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ストレージプロファイルの比較")
+    parser.add_argument('--writes', type=int, default=500)
+    parser.add_argument('--reads', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=20)
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    print(f"{'profile':<10} {'writes/s':>10} {'reads/s':>10}")
+    try:
+        for profile in PROFILES:
+            w, r = bench_profile(profile, work, args.writes, args.reads, args.users)
+            print(f"{profile:<10} {w:>10.0f} {r:>10.0f}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
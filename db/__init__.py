@@ -1,25 +1,98 @@
-import sqlite3
 import os
+from .shard import resolve_db_path, data_db_paths
+from .calendar import ensure_calendar
+from .percentile import ensure_percentile_tables
+from .storage import connect
+from .milestone import ensure_milestone_tables
+from .search import ensure_search_tables
 
 # このファイルのディレクトリパスを取得
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'app.db')
 SCHEMA_PATH = os.path.join(BASE_DIR, 'schema.sql')
 
-def get_db_connection():
-    """データベース接続を取得し、Rowファクトリを設定して返す"""
-    conn = sqlite3.connect(DB_PATH)
+# スキーマのバージョン (各DBファイルの PRAGMA user_version に記録する)
+# schema.sql や upgrade_schema() でテーブルを増やしたら1つ上げる
+SCHEMA_VERSION = 4
+
+def get_db_connection(user_id=None):
+    """
+    データベース接続を取得し、Rowファクトリを設定して返す
+    user_id を渡すと、シャーディング有効時はそのユーザーのシャードに接続する
+    """
     # カラム名で値を取得できるようにする (row['user_id'] のように)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # PRAGMA は保存設定のプロファイル (OSHI_STORAGE_PROFILE) に従う
+    return connect(resolve_db_path(DB_PATH, user_id))
+
+def upgrade_schema(conn):
+    """schema.sql の後から追加したテーブル (カレンダー表など) を、既存のDBにも作成する"""
+    # consistency は集計モジュールを使うので、循環importを避けてここで読み込む
+    from .consistency import ensure_digest_tables
+
+    # 購入履歴のキーセット方式のページングや期間の範囲検索で使うインデックス
+    # (schema.sql に後から追加したので、それより前に作ったDBにはここで作る)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_purchases_user_date ON purchases(user_id, purchase_date, purchase_id)"
+    )
+    ensure_calendar(conn)
+    ensure_percentile_tables(conn)
+    ensure_digest_tables(conn)
+    ensure_milestone_tables(conn)
+    ensure_search_tables(conn)
+
+def ensure_schema(conn, schema_path=SCHEMA_PATH):
+    """
+    PRAGMA user_version を見て、空のDBや古いDBだけ初期化・更新する
+    最新のDBなら PRAGMA を1回読むだけで終わる。何かした場合は True を返す
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return False
+
+    if version == 0:
+        # バージョン管理を始める前のDBかもしれないので、usersテーブルがあれば中身は残す
+        has_users = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'"
+        ).fetchone()
+        if has_users is None:
+            with open(schema_path, 'r', encoding='utf-8') as f:
+                conn.executescript(f.read())
+    upgrade_schema(conn)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+    return True
+
+# init_db で作り直す前に消す、purchases から作る派生テーブルとそのトリガー
+# schema.sql の DROP TABLE users は外部キーの CASCADE で purchases を削除するので、
+# 先に消しておかないと FTS のトリガーが "database table is locked" で失敗し、
+# 消えた購入の節目イベントやスケッチ・ダイジェストも古いまま残ってしまう
+_DERIVED_DROP_SQL = """
+DROP TRIGGER IF EXISTS trigger_purchases_fts_insert;
+DROP TRIGGER IF EXISTS trigger_purchases_fts_delete;
+DROP TRIGGER IF EXISTS trigger_purchases_fts_update;
+DROP TRIGGER IF EXISTS trigger_purchases_digest_insert;
+DROP TRIGGER IF EXISTS trigger_purchases_digest_delete;
+DROP TRIGGER IF EXISTS trigger_purchases_digest_update;
+DROP TABLE IF EXISTS purchase_memo_fts;
+DROP TABLE IF EXISTS badge_milestones;
+DROP TABLE IF EXISTS percentile_buckets;
+DROP TABLE IF EXISTS day_digests;
+DROP TABLE IF EXISTS verified_digests;
+"""
 
 def init_db():
-    """schema.sql を読み込んでテーブルを作成する"""
+    """schema.sql を読み込んでテーブルを作成する (シャーディング時は全シャードにも作成)"""
     if not os.path.exists(SCHEMA_PATH):
         raise FileNotFoundError(f"Schema file not found at {SCHEMA_PATH}")
 
-    conn = get_db_connection()
     with open(SCHEMA_PATH, 'r', encoding='utf-8') as f:
-        conn.executescript(f.read())
-    conn.close()
-    print(f"Database initialized at: {DB_PATH}")
\ No newline at end of file
+        schema_sql = f.read()
+
+    for path in dict.fromkeys([DB_PATH] + data_db_paths(DB_PATH)):
+        conn = connect(path)
+        conn.executescript(_DERIVED_DROP_SQL)
+        conn.executescript(schema_sql)
+        upgrade_schema(conn)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.close()
+    print(f"Database initialized at: {DB_PATH}")
@@ -0,0 +1,285 @@
+"""
+オンラインバックアップ
+
+DBファイルをそのままコピーすると書き込み途中の壊れたコピーになりうるし、
+ロックを取ってコピーすると、その間 /insert が止まってしまう。
+ここでは SQLite のオンラインバックアップAPIで、数百ページずつコピーしては休む。
+
+- WAL モードでは、コピー元の接続で読み込みトランザクションを開いたままにしてスナップショットを固定する。
+  書き込みはその間も普通に進む。途中の書き込みでコピーがやり直しになることはなく、
+  開始時点の一貫した状態がそのまま取れる (そのぶん WAL のチェックポイントはバックアップ後まで進まない)
+- ロールバックジャーナルのDBでは読み込みロックを持ち続けると書き込みが止まるので、固定しない。
+  途中で書き込まれるとやり直しになり、MAX_RESTARTS 回を超えたら諦める
+- 1ステップごとに少し休み、max_rate (バイト/秒) を超えないように間隔を空ける
+- 一時ファイルに書き出し、integrity_check と行数の照合に通ってから本来の名前に置き換える
+
+    python -m db.backup run [db_path] --dest backups/           # 1回バックアップ
+    python -m db.backup schedule [db_path] --dest backups/ --interval 3600 --keep 24
+    python -m db.backup verify backups/app-20250101-000000.db
+    python -m db.backup restore backups/app-20250101-000000.db app.db
+"""
+import argparse
+import datetime
+import glob
+import os
+import threading
+import time
+
+from .storage import connect
+
+# 1ステップでコピーするページ数
+PAGES_PER_STEP = 256
+# ステップ間で最低限休む秒数 (書き込みにロックを譲る)
+STEP_PAUSE = 0.01
+# ロールバックジャーナルのDBで、途中の書き込みによるやり直しを許す回数
+MAX_RESTARTS = 5
+
+# 照合用に行数を数えるテーブル (存在するものだけ数える)
+_COUNTED_TABLES = (
+    'users', 'badge_settings', 'purchases',
+    'daily_summaries', 'weekly_summaries', 'monthly_summaries', 'badge_milestones',
+)
+
+
+def _table_counts(conn):
+    """照合用に、主なテーブルの行数を返す"""
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    return {
+        table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        for table in _COUNTED_TABLES if table in existing
+    }
+
+
+def verify_backup(path, expected_counts=None, full=True):
+    """
+    バックアップファイルを開いて検査し、問題があれば RuntimeError を送出する
+    - full=True なら PRAGMA integrity_check、False なら quick_check
+    - expected_counts を渡すと、テーブルごとの行数も照合する
+    戻り値はテーブルごとの行数
+    """
+    conn = connect(path, read_only=True)
+    try:
+        pragma = 'integrity_check' if full else 'quick_check'
+        result = [tuple(row) for row in conn.execute(f"PRAGMA {pragma}")]
+        if result != [('ok',)]:
+            raise RuntimeError(f"{pragma} failed for {path}: {result[:5]}")
+        counts = _table_counts(conn)
+    finally:
+        conn.close()
+
+    if expected_counts is not None and counts != expected_counts:
+        raise RuntimeError(f"Row counts differ from source for {path}: {counts} != {expected_counts}")
+    return counts
+
+
+def backup_database(src_path, dest_path, pages_per_step=PAGES_PER_STEP, max_rate=None,
+                    step_pause=STEP_PAUSE, verify=True, progress=None):
+    """
+    src_path のDBを dest_path にオンラインバックアップする
+    max_rate: 1秒あたりにコピーする最大バイト数 (None なら制限なし)
+    progress: (コピー済みページ数, 全ページ数) を受け取る関数
+    戻り値: {'pages': 全ページ数, 'restarts': やり直し回数, 'seconds': 所要時間, 'counts': 行数}
+    """
+    partial = dest_path + '.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+
+    src = connect(src_path, read_only=True)
+    dst = connect(partial)
+    started = time.monotonic()
+    state = {'restarts': 0, 'remaining': None, 'last_step': started, 'pages': 0}
+    try:
+        page_size = src.execute("PRAGMA page_size").fetchone()[0]
+        pinned = src.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal'
+        expected_counts = None
+        if pinned:
+            # 読み込みトランザクションを開いてスナップショットを固定する (書き込みは止めない)
+            src.execute("BEGIN")
+            expected_counts = _table_counts(src)
+
+        def on_step(status, remaining, total):
+            if state['remaining'] is not None and remaining > state['remaining']:
+                # コピー元が書き換えられて最初からやり直しになった
+                state['restarts'] += 1
+                if state['restarts'] > MAX_RESTARTS:
+                    raise RuntimeError(
+                        f"Backup of {src_path} restarted more than {MAX_RESTARTS} times; "
+                        "use a WAL storage profile for online backups under write load"
+                    )
+            state['remaining'] = remaining
+            state['pages'] = total
+            if progress is not None:
+                progress(total - remaining, total)
+
+            # 次のステップまで休む (転送量の上限があれば、それに合わせて間隔を空ける)
+            pause = step_pause
+            if max_rate:
+                elapsed = time.monotonic() - state['last_step']
+                pause = max(pause, pages_per_step * page_size / max_rate - elapsed)
+            if remaining > 0 and pause > 0:
+                time.sleep(pause)
+            state['last_step'] = time.monotonic()
+
+        src.backup(dst, pages=pages_per_step, progress=on_step)
+        if pinned:
+            src.rollback()
+        # WAL のDBのコピーは WAL モードのままなので、-wal / -shm の要らない1ファイルに戻しておく
+        dst.execute("PRAGMA journal_mode = DELETE")
+    finally:
+        dst.close()
+        src.close()
+
+    try:
+        counts = verify_backup(partial, expected_counts) if verify else None
+    except Exception:
+        os.remove(partial)
+        raise
+    os.replace(partial, dest_path)
+    return {
+        'pages': state['pages'],
+        'restarts': state['restarts'],
+        'seconds': time.monotonic() - started,
+        'counts': counts,
+    }
+
+
+def backup_name(src_path, when=None):
+    """'app.db' -> 'app-20250101-120000.db' のようなバックアップファイル名"""
+    root, ext = os.path.splitext(os.path.basename(src_path))
+    when = when or datetime.datetime.now()
+    return f"{root}-{when.strftime('%Y%m%d-%H%M%S')}{ext}"
+
+
+def prune_backups(dest_dir, src_path, keep):
+    """src_path のバックアップのうち、新しい keep 個を残して削除する。削除したパスを返す"""
+    root, ext = os.path.splitext(os.path.basename(src_path))
+    backups = sorted(glob.glob(os.path.join(dest_dir, f"{glob.escape(root)}-*{ext}")))
+    removed = backups[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def backup_all(db_paths, dest_dir, keep=None, **options):
+    """複数のDBファイル (ディレクトリDBと各シャード) を順にバックアップし、(元, 先, 結果) のリストを返す"""
+    os.makedirs(dest_dir, exist_ok=True)
+    now = datetime.datetime.now()
+    results = []
+    for path in db_paths:
+        dest = os.path.join(dest_dir, backup_name(path, now))
+        results.append((path, dest, backup_database(path, dest, **options)))
+        if keep:
+            prune_backups(dest_dir, path, keep)
+    return results
+
+
+def restore_backup(backup_path, dest_path):
+    """
+    検査済みのバックアップを dest_path に書き戻す (アプリを止めてから実行する)
+    バックアップを先に検査し、壊れていれば書き戻さない
+    """
+    verify_backup(backup_path)
+    src = connect(backup_path, read_only=True)
+    dst = connect(dest_path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    return verify_backup(dest_path)
+
+
+class BackupScheduler:
+    """interval 秒ごとに backup_all を実行するスレッド"""
+
+    def __init__(self, db_paths_func, dest_dir, interval, keep=None, **options):
+        # シャード構成が変わっても追従できるよう、パスは毎回関数から取る
+        self.db_paths_func = db_paths_func
+        self.dest_dir = dest_dir
+        self.interval = interval
+        self.keep = keep
+        self.options = options
+        self.last_results = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """スケジューラを起動する (起動済みなら何もしない)"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="backup-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """実行中のバックアップが終わるのを待ってから止める"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.last_results = backup_all(self.db_paths_func(), self.dest_dir, self.keep, **self.options)
+                self.last_error = None
+            except Exception as e:
+                # 失敗しても次の回は試す
+                self.last_error = e
+                print(f"Backup failed: {e}")
+
+
+def main():
+    from . import DB_PATH
+    from .shard import data_db_paths
+
+    def all_paths(base):
+        return list(dict.fromkeys([base] + data_db_paths(base)))
+
+    parser = argparse.ArgumentParser(description="DBのオンラインバックアップ")
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('run', "1回バックアップする"), ('schedule', "一定間隔でバックアップし続ける")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument('db_path', nargs='?', default=DB_PATH,
+                       help="対象のDB (シャーディング時は全シャードも対象)")
+        p.add_argument('--dest', default='backups', help="バックアップの保存先ディレクトリ")
+        p.add_argument('--pages', type=int, default=PAGES_PER_STEP, help="1ステップでコピーするページ数")
+        p.add_argument('--rate', type=float, default=None, help="転送量の上限 (MB/秒)")
+        p.add_argument('--keep', type=int, default=None, help="残すバックアップの数 (DBファイルごと)")
+        if name == 'schedule':
+            p.add_argument('--interval', type=float, default=3600, help="バックアップの間隔 (秒)")
+    p = sub.add_parser('verify', help="バックアップファイルを検査する")
+    p.add_argument('backup_path')
+    p = sub.add_parser('restore', help="バックアップを検査してから書き戻す")
+    p.add_argument('backup_path')
+    p.add_argument('db_path')
+    args = parser.parse_args()
+
+    if args.command in ('run', 'schedule'):
+        options = {
+            'pages_per_step': args.pages,
+            'max_rate': args.rate * 1024 * 1024 if args.rate else None,
+        }
+        if args.command == 'run':
+            for src, dest, result in backup_all(all_paths(args.db_path), args.dest, args.keep, **options):
+                print(f"Backed up {src} -> {dest} ({result['pages']} pages, "
+                      f"{result['seconds']:.1f}s, restarts: {result['restarts']})")
+        else:
+            scheduler = BackupScheduler(lambda: all_paths(args.db_path), args.dest, args.interval,
+                                        args.keep, **options)
+            scheduler.start()
+            print(f"Backing up {args.db_path} every {args.interval:g}s into {args.dest} (Ctrl+C to stop)")
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                scheduler.stop()
+    elif args.command == 'verify':
+        counts = verify_backup(args.backup_path)
+        print(f"OK: {args.backup_path} {counts}")
+    elif args.command == 'restore':
+        counts = restore_backup(args.backup_path, args.db_path)
+        print(f"Restored {args.backup_path} -> {args.db_path} {counts}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,40 +1,76 @@
 from . import get_db_connection
 
+# 設定行がまだ無いユーザー用の既定値 (schema.sql の DEFAULT と同じ)
+DEFAULT_BADGE_PRICE = 600
+DEFAULT_BADGES_PER_BAG = 35
+DEFAULT_ITABAG_TOTAL_PRICE = 19250
+
 def create_default_settings(user_id):
     """ユーザー作成時にデフォルト設定を保存する"""
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     conn.execute(
         """
-        INSERT INTO badge_settings 
-        (user_id, badge_price, itabag_badge_count, itabag_total_price)
-        VALUES (?, 600, 35, 19250)
+        INSERT INTO badge_settings
+        (user_id, badge_price, badges_per_bag, itabag_total_price)
+        VALUES (?, ?, ?, ?)
         """,
-        (user_id,)
+        (user_id, DEFAULT_BADGE_PRICE, DEFAULT_BADGES_PER_BAG, DEFAULT_ITABAG_TOTAL_PRICE)
     )
     conn.commit()
     conn.close()
 
-def get_settings(user_id):
-    """ユーザーの設定を取得する"""
-    conn = get_db_connection()
-    settings = conn.execute(
+def fetch_settings(conn, user_id):
+    """渡された接続でユーザーの設定を取得する (無ければ None)"""
+    return conn.execute(
         "SELECT * FROM badge_settings WHERE user_id = ?", (user_id,)
     ).fetchone()
+
+def get_settings(user_id):
+    """ユーザーの設定を取得する"""
+    conn = get_db_connection(user_id)
+    settings = fetch_settings(conn, user_id)
     conn.close()
     return settings
 
-def update_settings(user_id, badge_price, itabag_badge_count):
-    """設定を更新する（痛バ総額は自動計算）"""
-    itabag_total_price = badge_price * itabag_badge_count
-    
-    conn = get_db_connection()
-    conn.execute(
-        """
-        UPDATE badge_settings
-        SET badge_price = ?, itabag_badge_count = ?, itabag_total_price = ?
-        WHERE user_id = ?
-        """,
-        (badge_price, itabag_badge_count, itabag_total_price, user_id)
-    )
-    conn.commit()
-    conn.close()
\ No newline at end of file
+def update_settings(user_id, badge_price, badges_per_bag):
+    """
+    設定を更新する（痛バ総額は自動計算）
+    保存済みの日次・週次・月次集計の換算値も、同じトランザクションで新しいレートに付け直す
+    """
+    # summary は badge_setting を読み込むので、循環importを避けてここで読み込む
+    from .summary import rerate_summaries
+
+    itabag_total_price = badge_price * badges_per_bag
+
+    conn = get_db_connection(user_id)
+    try:
+        # 集計の書き込みと入れ違いにならないよう、先に書き込みロックを取る
+        conn.execute("BEGIN IMMEDIATE")
+        current = fetch_settings(conn, user_id)
+        old_badge_price = current['badge_price'] if current else DEFAULT_BADGE_PRICE
+
+        if current:
+            conn.execute(
+                """
+                UPDATE badge_settings
+                SET badge_price = ?, badges_per_bag = ?, itabag_total_price = ?
+                WHERE user_id = ?
+                """,
+                (badge_price, badges_per_bag, itabag_total_price, user_id)
+            )
+        else:
+            conn.execute(
+                """
+                INSERT INTO badge_settings
+                (user_id, badge_price, badges_per_bag, itabag_total_price)
+                VALUES (?, ?, ?, ?)
+                """,
+                (user_id, badge_price, badges_per_bag, itabag_total_price)
+            )
+        rerate_summaries(conn, user_id, badge_price, itabag_total_price, old_badge_price)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,197 @@
+"""
+カレンダー表 (日付ディメンション)
+
+各日付について、その週の開始日(日曜)・終了日(土曜)と年・月を前もって
+計算して持っておく。週次・月次の集計は purchases とこの表を JOIN して
+GROUP BY するだけで、複数期間をまとめて1本のSQLで出せる。
+"""
+import datetime
+
+# 初期化時に埋めておく範囲
+CALENDAR_START = '2000-01-01'
+CALENDAR_END = '2099-12-31'
+
+_CALENDAR_DDL = """
+CREATE TABLE IF NOT EXISTS calendar (
+    cal_date TEXT PRIMARY KEY,  -- YYYY-MM-DD形式
+    week_start TEXT NOT NULL,   -- 週の開始日 (日曜日)
+    week_end TEXT NOT NULL,     -- 週の終了日 (土曜日)
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_calendar_week ON calendar(week_start);
+CREATE INDEX IF NOT EXISTS idx_calendar_month ON calendar(year, month);
+"""
+
+# purchases の金額列を期間ごとに合計する SELECT 句 (p = purchases)
+_SUM_COLUMNS = """
+    COALESCE(SUM(p.drink_amount), 0) AS drink,
+    COALESCE(SUM(p.snack_amount), 0) AS snack,
+    COALESCE(SUM(p.main_dish_amount), 0) AS main,
+    COALESCE(SUM(p.irregular_amount), 0) AS irregular,
+    COALESCE(SUM(p.drink_amount + p.snack_amount + p.main_dish_amount + p.irregular_amount), 0) AS total
+"""
+
+
+def normalize_date(date_str):
+    """
+    日付を 'YYYY-MM-DD' (ゼロ埋め) にそろえて返す (不正な場合は ValueError)
+    '2025-3-5' のような形は strptime では通るが、SQLite の date() では NULL になり
+    カレンダー表とも一致しないので、集計に使う前に必ずこの形にしておく
+    """
+    return datetime.datetime.strptime(date_str, '%Y-%m-%d').strftime('%Y-%m-%d')
+
+
+def fill_calendar(conn, start_date, end_date):
+    """start_date〜end_date の日付をカレンダー表に追加する (既存の日付はそのまま)"""
+    conn.execute("""
+        WITH RECURSIVE dates(d) AS (
+            SELECT date(?)
+            UNION ALL
+            SELECT date(d, '+1 day') FROM dates WHERE d < date(?)
+        )
+        INSERT OR IGNORE INTO calendar (cal_date, week_start, week_end, year, month)
+        SELECT
+            d,
+            date(d, '-' || strftime('%w', d) || ' days'),
+            date(d, '-' || strftime('%w', d) || ' days', '+6 days'),
+            CAST(strftime('%Y', d) AS INTEGER),
+            CAST(strftime('%m', d) AS INTEGER)
+        FROM dates
+    """, (start_date, end_date))
+
+
+def ensure_calendar(conn):
+    """カレンダー表が無ければ作成し、空なら既定の範囲を埋める"""
+    conn.executescript(_CALENDAR_DDL)
+    if conn.execute("SELECT 1 FROM calendar LIMIT 1").fetchone() is None:
+        fill_calendar(conn, CALENDAR_START, CALENDAR_END)
+        conn.commit()
+
+
+def week_bounds(conn, start_date, end_date):
+    """start_date を含む週の日曜日と、end_date を含む週の土曜日を返す"""
+    row = conn.execute("""
+        SELECT
+            (SELECT week_start FROM calendar WHERE cal_date = ?) AS first_day,
+            (SELECT week_end FROM calendar WHERE cal_date = ?) AS last_day
+    """, (start_date, end_date)).fetchone()
+    return row[0], row[1]
+
+
+def month_bounds(conn, start_date, end_date):
+    """start_date を含む月の1日と、end_date を含む月の末日を返す"""
+    row = conn.execute(
+        "SELECT date(?, 'start of month'), date(?, 'start of month', '+1 month', '-1 day')",
+        (start_date, end_date)
+    ).fetchone()
+    return row[0], row[1]
+
+
+def rebuild_weekly_summaries(conn, user_id, start_date, end_date, badge_price, itabag_total_price):
+    """
+    start_date〜end_date にかかる全ての週の週次集計を、JOIN + GROUP BY の1本のSQLで作り直す
+    購入が無くなった週の集計行は削除する。コミットは呼び出し側で行う
+    """
+    # カレンダー表の範囲外の日付が来ても JOIN から漏れないように補う
+    fill_calendar(conn, start_date, end_date)
+    first_day, last_day = week_bounds(conn, start_date, end_date)
+    conn.execute(f"""
+        INSERT INTO weekly_summaries
+            (user_id, start_date, end_date, drink_total, snack_total, main_dish_total,
+             irregular_total, weekly_total, badge_equivalent, itabag_equivalent)
+        SELECT user_id, week_start, week_end, drink, snack, main, irregular, total,
+               COALESCE(total * 1.0 / NULLIF(?, 0), 0), COALESCE(total * 1.0 / NULLIF(?, 0), 0)
+        FROM (
+            SELECT p.user_id, c.week_start, c.week_end, {_SUM_COLUMNS}
+            FROM purchases p
+            JOIN calendar c ON c.cal_date = p.purchase_date
+            WHERE p.user_id = ? AND p.purchase_date BETWEEN ? AND ?
+            GROUP BY c.week_start
+        )
+        WHERE true
+        ON CONFLICT(user_id, start_date) DO UPDATE SET
+            end_date=excluded.end_date, drink_total=excluded.drink_total,
+            snack_total=excluded.snack_total, main_dish_total=excluded.main_dish_total,
+            irregular_total=excluded.irregular_total, weekly_total=excluded.weekly_total,
+            badge_equivalent=excluded.badge_equivalent, itabag_equivalent=excluded.itabag_equivalent,
+            updated_at=DATETIME('now', 'localtime')
+    """, (badge_price, itabag_total_price, user_id, first_day, last_day))
+    conn.execute("""
+        DELETE FROM weekly_summaries
+        WHERE user_id = ? AND start_date BETWEEN ? AND ?
+        AND NOT EXISTS (
+            SELECT 1 FROM purchases p
+            WHERE p.user_id = weekly_summaries.user_id
+            AND p.purchase_date BETWEEN weekly_summaries.start_date AND weekly_summaries.end_date
+        )
+    """, (user_id, first_day, last_day))
+
+
+def rebuild_monthly_summaries(conn, user_id, start_date, end_date, badge_price, itabag_total_price):
+    """
+    start_date〜end_date にかかる全ての月の月次集計を、JOIN + GROUP BY の1本のSQLで作り直す
+    購入が無くなった月の集計行は削除する。コミットは呼び出し側で行う
+    """
+    fill_calendar(conn, start_date, end_date)
+    first_day, last_day = month_bounds(conn, start_date, end_date)
+    conn.execute(f"""
+        INSERT INTO monthly_summaries
+            (user_id, year, month, drink_total, snack_total, main_dish_total,
+             irregular_total, monthly_total, badge_equivalent, itabag_equivalent)
+        SELECT user_id, year, month, drink, snack, main, irregular, total,
+               COALESCE(total * 1.0 / NULLIF(?, 0), 0), COALESCE(total * 1.0 / NULLIF(?, 0), 0)
+        FROM (
+            SELECT p.user_id, c.year, c.month, {_SUM_COLUMNS}
+            FROM purchases p
+            JOIN calendar c ON c.cal_date = p.purchase_date
+            WHERE p.user_id = ? AND p.purchase_date BETWEEN ? AND ?
+            GROUP BY c.year, c.month
+        )
+        WHERE true
+        ON CONFLICT(user_id, year, month) DO UPDATE SET
+            drink_total=excluded.drink_total, snack_total=excluded.snack_total,
+            main_dish_total=excluded.main_dish_total, irregular_total=excluded.irregular_total,
+            monthly_total=excluded.monthly_total,
+            badge_equivalent=excluded.badge_equivalent, itabag_equivalent=excluded.itabag_equivalent,
+            updated_at=DATETIME('now', 'localtime')
+    """, (badge_price, itabag_total_price, user_id, first_day, last_day))
+    conn.execute("""
+        DELETE FROM monthly_summaries
+        WHERE user_id = ? AND printf('%04d-%02d-01', year, month) BETWEEN ? AND ?
+        AND NOT EXISTS (
+            SELECT 1 FROM purchases p
+            WHERE p.user_id = monthly_summaries.user_id
+            AND p.purchase_date BETWEEN printf('%04d-%02d-01', monthly_summaries.year, monthly_summaries.month)
+                                    AND printf('%04d-%02d-31', monthly_summaries.year, monthly_summaries.month)
+        )
+    """, (user_id, first_day, last_day))
+
+
+def get_weekly_report(conn, user_id, start_date, end_date):
+    """
+    start_date〜end_date にかかる週ごとの支出を1本のSQLで返す
+    購入の無い週も 0 円として含める (カレンダー表を起点に LEFT JOIN)
+    """
+    first_day, last_day = week_bounds(conn, start_date, end_date)
+    return conn.execute(f"""
+        SELECT c.week_start, c.week_end, {_SUM_COLUMNS}
+        FROM calendar c
+        LEFT JOIN purchases p ON p.purchase_date = c.cal_date AND p.user_id = ?
+        WHERE c.cal_date BETWEEN ? AND ?
+        GROUP BY c.week_start
+        ORDER BY c.week_start
+    """, (user_id, first_day, last_day)).fetchall()
+
+
+def get_monthly_report(conn, user_id, start_date, end_date):
+    """start_date〜end_date にかかる月ごとの支出を1本のSQLで返す (購入の無い月も含む)"""
+    first_day, last_day = month_bounds(conn, start_date, end_date)
+    return conn.execute(f"""
+        SELECT c.year, c.month, {_SUM_COLUMNS}
+        FROM calendar c
+        LEFT JOIN purchases p ON p.purchase_date = c.cal_date AND p.user_id = ?
+        WHERE c.cal_date BETWEEN ? AND ?
+        GROUP BY c.year, c.month
+        ORDER BY c.year, c.month
+    """, (user_id, first_day, last_day)).fetchall()
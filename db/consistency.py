@@ -0,0 +1,360 @@
+"""
+集計テーブル (daily/weekly/monthly_summaries) と purchases の整合性チェック
+
+purchases へのINSERT/UPDATE/DELETEのたびに、トリガーで (ユーザー, 日) ごとの
+ダイジェスト (件数・カテゴリ別合計・最大 purchase_id) を day_digests に更新しておく。
+トリガーは購入と同じトランザクションで動くので、集計更新の前にプロセスが
+落ちてもダイジェストは purchases と必ず一致する。
+
+チェックでは、ダイジェストを週・月にまとめたものを前回検証時の値
+(verified_digests) と比べ、変わった月の範囲だけ集計テーブルと突き合わせる。
+ずれていればその場で集計を作り直す。ユーザーごとに並列で実行できる。
+
+差分チェックで見つかるのは「購入が変わったのに集計が追いついていない」ずれだけで、
+購入は変わらず集計テーブルの方が直接書き換えられた・壊れた場合はダイジェストが
+変わらないので見つからない。そのため毎回 SAMPLE_RATE の割合のユーザーは全期間を検証し、
+それとは別に --full を定期的 (週1回など) に実行する。
+
+    python -m db.consistency check               # 変わった期間だけ検証 (一部のユーザーは全期間)
+    python -m db.consistency check --sample 0    # 変わった期間だけ検証
+    python -m db.consistency check --full        # 全ユーザーの全期間を検証
+"""
+import argparse
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from .calendar import week_bounds, month_bounds
+from .storage import connect
+from .summary import _upsert_daily, rebuild_summaries
+
+# 差分チェックのたびに全期間を検証するユーザーの割合
+SAMPLE_RATE = 0.05
+
+_DIGEST_DDL = """
+CREATE TABLE IF NOT EXISTS day_digests (
+    user_id INTEGER NOT NULL,
+    day TEXT NOT NULL, -- YYYY-MM-DD形式
+    row_count INTEGER NOT NULL DEFAULT 0,
+    drink_sum INTEGER NOT NULL DEFAULT 0,
+    snack_sum INTEGER NOT NULL DEFAULT 0,
+    main_sum INTEGER NOT NULL DEFAULT 0,
+    irregular_sum INTEGER NOT NULL DEFAULT 0,
+    max_purchase_id INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+
+-- 前回の検証で集計と一致を確認したときのダイジェスト
+-- period_type: 'day' / 'week' / 'month'  period_key: 'YYYY-MM-DD' (週は開始日) / 'YYYY-MM'
+CREATE TABLE IF NOT EXISTS verified_digests (
+    user_id INTEGER NOT NULL,
+    period_type TEXT NOT NULL,
+    period_key TEXT NOT NULL,
+    row_count INTEGER NOT NULL,
+    drink_sum INTEGER NOT NULL,
+    snack_sum INTEGER NOT NULL,
+    main_sum INTEGER NOT NULL,
+    irregular_sum INTEGER NOT NULL,
+    max_purchase_id INTEGER NOT NULL,
+    verified_at TEXT DEFAULT (DATETIME('now', 'localtime')),
+    PRIMARY KEY (user_id, period_type, period_key)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trigger_purchases_digest_insert
+AFTER INSERT ON purchases
+BEGIN
+    INSERT INTO day_digests (user_id, day, row_count, drink_sum, snack_sum, main_sum, irregular_sum, max_purchase_id)
+    VALUES (NEW.user_id, NEW.purchase_date, 1,
+            IFNULL(NEW.drink_amount, 0), IFNULL(NEW.snack_amount, 0),
+            IFNULL(NEW.main_dish_amount, 0), IFNULL(NEW.irregular_amount, 0), NEW.purchase_id)
+    ON CONFLICT(user_id, day) DO UPDATE SET
+        row_count = row_count + 1,
+        drink_sum = drink_sum + excluded.drink_sum,
+        snack_sum = snack_sum + excluded.snack_sum,
+        main_sum = main_sum + excluded.main_sum,
+        irregular_sum = irregular_sum + excluded.irregular_sum,
+        max_purchase_id = MAX(max_purchase_id, excluded.max_purchase_id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trigger_purchases_digest_delete
+AFTER DELETE ON purchases
+BEGIN
+    UPDATE day_digests SET
+        row_count = row_count - 1,
+        drink_sum = drink_sum - IFNULL(OLD.drink_amount, 0),
+        snack_sum = snack_sum - IFNULL(OLD.snack_amount, 0),
+        main_sum = main_sum - IFNULL(OLD.main_dish_amount, 0),
+        irregular_sum = irregular_sum - IFNULL(OLD.irregular_amount, 0),
+        max_purchase_id = IFNULL((SELECT MAX(purchase_id) FROM purchases
+                                  WHERE user_id = OLD.user_id AND purchase_date = OLD.purchase_date), 0)
+    WHERE user_id = OLD.user_id AND day = OLD.purchase_date;
+    DELETE FROM day_digests WHERE user_id = OLD.user_id AND day = OLD.purchase_date AND row_count <= 0;
+END;
+
+-- updated_at の自動更新 (trigger_purchases_updated_at) では発火しないよう、対象の列を限定する
+CREATE TRIGGER IF NOT EXISTS trigger_purchases_digest_update
+AFTER UPDATE OF user_id, purchase_date, drink_amount, snack_amount, main_dish_amount, irregular_amount ON purchases
+BEGIN
+    UPDATE day_digests SET
+        row_count = row_count - 1,
+        drink_sum = drink_sum - IFNULL(OLD.drink_amount, 0),
+        snack_sum = snack_sum - IFNULL(OLD.snack_amount, 0),
+        main_sum = main_sum - IFNULL(OLD.main_dish_amount, 0),
+        irregular_sum = irregular_sum - IFNULL(OLD.irregular_amount, 0)
+    WHERE user_id = OLD.user_id AND day = OLD.purchase_date;
+    INSERT INTO day_digests (user_id, day, row_count, drink_sum, snack_sum, main_sum, irregular_sum, max_purchase_id)
+    VALUES (NEW.user_id, NEW.purchase_date, 1,
+            IFNULL(NEW.drink_amount, 0), IFNULL(NEW.snack_amount, 0),
+            IFNULL(NEW.main_dish_amount, 0), IFNULL(NEW.irregular_amount, 0), NEW.purchase_id)
+    ON CONFLICT(user_id, day) DO UPDATE SET
+        row_count = row_count + 1,
+        drink_sum = drink_sum + excluded.drink_sum,
+        snack_sum = snack_sum + excluded.snack_sum,
+        main_sum = main_sum + excluded.main_sum,
+        irregular_sum = irregular_sum + excluded.irregular_sum,
+        max_purchase_id = MAX(max_purchase_id, excluded.max_purchase_id);
+    UPDATE day_digests SET
+        max_purchase_id = IFNULL((SELECT MAX(purchase_id) FROM purchases
+                                  WHERE user_id = OLD.user_id AND purchase_date = OLD.purchase_date), 0)
+    WHERE user_id = OLD.user_id AND day = OLD.purchase_date;
+    DELETE FROM day_digests WHERE user_id = OLD.user_id AND day = OLD.purchase_date AND row_count <= 0;
+END;
+"""
+
+# ダイジェストの値の列 (verified_digests と同じ並び)
+_DIGEST_COLUMNS = ('row_count', 'drink_sum', 'snack_sum', 'main_sum', 'irregular_sum', 'max_purchase_id')
+
+# 期間の種類ごとの「ダイジェストのまとめ方」(d = day_digests, c = calendar)
+_PERIOD_KEY_SQL = {
+    'day': "d.day",
+    'week': "c.week_start",
+    'month': "printf('%04d-%02d', c.year, c.month)",
+}
+
+# 期間の種類ごとの集計テーブルの読み方 (period_key と4カテゴリの合計、期間の合計)
+_SUMMARY_SQL = {
+    'day': """
+        SELECT summary_date, drink_total, snack_total, main_dish_total, irregular_total, daily_total
+        FROM daily_summaries WHERE user_id = ? AND summary_date BETWEEN ? AND ?
+    """,
+    'week': """
+        SELECT start_date, drink_total, snack_total, main_dish_total, irregular_total, weekly_total
+        FROM weekly_summaries WHERE user_id = ? AND start_date BETWEEN ? AND ?
+    """,
+    'month': """
+        SELECT printf('%04d-%02d', year, month), drink_total, snack_total, main_dish_total, irregular_total, monthly_total
+        FROM monthly_summaries WHERE user_id = ? AND printf('%04d-%02d-01', year, month) BETWEEN ? AND ?
+    """,
+}
+
+
+def ensure_digest_tables(conn):
+    """ダイジェスト用のテーブルとトリガーを作成し、新規作成時は既存の購入から埋める"""
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'day_digests'"
+    ).fetchone() is None
+    conn.executescript(_DIGEST_DDL)
+    if created:
+        with conn:
+            conn.execute("""
+                INSERT INTO day_digests
+                    (user_id, day, row_count, drink_sum, snack_sum, main_sum, irregular_sum, max_purchase_id)
+                SELECT user_id, purchase_date, COUNT(*),
+                       TOTAL(drink_amount), TOTAL(snack_amount), TOTAL(main_dish_amount), TOTAL(irregular_amount),
+                       MAX(purchase_id)
+                FROM purchases
+                GROUP BY user_id, purchase_date
+            """)
+
+
+def _current_digests(conn, user_id, period_type, first_day=None, last_day=None):
+    """day_digests を期間ごとにまとめた現在のダイジェスト {period_key: (件数, 合計..., 最大ID)}"""
+    sql = f"""
+        SELECT {_PERIOD_KEY_SQL[period_type]} AS period_key,
+               SUM(d.row_count), SUM(d.drink_sum), SUM(d.snack_sum), SUM(d.main_sum),
+               SUM(d.irregular_sum), MAX(d.max_purchase_id)
+        FROM day_digests d
+        JOIN calendar c ON c.cal_date = d.day
+        WHERE d.user_id = ?
+    """
+    params = [user_id]
+    if first_day is not None:
+        sql += " AND d.day BETWEEN ? AND ?"
+        params += [first_day, last_day]
+    sql += " GROUP BY period_key"
+    return {row[0]: tuple(int(v) for v in row[1:]) for row in conn.execute(sql, params)}
+
+
+def _verified_digests(conn, user_id, period_type, first_key=None, last_key=None):
+    """前回検証時のダイジェスト {period_key: (件数, 合計..., 最大ID)}"""
+    sql = f"""
+        SELECT period_key, {', '.join(_DIGEST_COLUMNS)}
+        FROM verified_digests WHERE user_id = ? AND period_type = ?
+    """
+    params = [user_id, period_type]
+    if first_key is not None:
+        sql += " AND period_key BETWEEN ? AND ?"
+        params += [first_key, last_key]
+    return {row[0]: tuple(row[1:]) for row in conn.execute(sql, params)}
+
+
+def _changed_months(conn, user_id, full=False):
+    """ダイジェストが前回検証時から変わった月 ('YYYY-MM') の一覧"""
+    current = _current_digests(conn, user_id, 'month')
+    verified = _verified_digests(conn, user_id, 'month')
+    if full:
+        # 購入が1件も無い月に残った集計行も見るため、集計テーブル側にある月も含める
+        summary_months = {row[0] for row in conn.execute("""
+            SELECT printf('%04d-%02d', year, month) FROM monthly_summaries WHERE user_id = ?
+            UNION SELECT substr(summary_date, 1, 7) FROM daily_summaries WHERE user_id = ?
+            UNION SELECT substr(start_date, 1, 7) FROM weekly_summaries WHERE user_id = ?
+        """, (user_id, user_id, user_id))}
+        return sorted(current.keys() | verified.keys() | summary_months)
+    return sorted(k for k in current.keys() | verified.keys() if current.get(k) != verified.get(k))
+
+
+def _verify_range(conn, user_id, month_first, month_last, full):
+    """
+    month_first〜month_last (月の区切りに揃えた範囲) にかかる日・週・月について、
+    ダイジェストが変わった期間の集計を突き合わせ、ずれていれば作り直す
+    戻り値: (検証した期間数, 修復した期間数)
+    """
+    # 日・週は月をまたぐ週の分まで広げた範囲、月はその月だけを見る
+    week_first, week_last = week_bounds(conn, month_first, month_last)
+    ranges = {
+        'day': (week_first, week_last, week_first, week_last),
+        'week': (week_first, week_last, week_first, week_last),
+        'month': (month_first, month_last, month_first[:7], month_last[:7]),
+    }
+
+    checked = repaired = 0
+    needs_rebuild = False
+    new_verified = []
+    for period_type, (first_day, last_day, first_key, last_key) in ranges.items():
+        current = _current_digests(conn, user_id, period_type, first_day, last_day)
+        verified = _verified_digests(conn, user_id, period_type, first_key, last_key)
+        summaries = {
+            row[0]: tuple(v or 0 for v in row[1:])
+            for row in conn.execute(_SUMMARY_SQL[period_type], (user_id, first_day, last_day))
+        }
+        # 購入が無いのに残っている集計行はダイジェストが変わらなくても確認する
+        orphans = summaries.keys() - current.keys()
+
+        for key in current.keys() | verified.keys() | summaries.keys():
+            digest = current.get(key)
+            if not full and digest == verified.get(key) and key not in orphans:
+                continue
+            checked += 1
+            # 4カテゴリの合計と、それらを足した期間の合計が一致するか
+            expected = digest[1:5] + (sum(digest[1:5]),) if digest else (0, 0, 0, 0, 0)
+            if summaries.get(key, (0, 0, 0, 0, 0)) != expected:
+                repaired += 1
+                if period_type == 'day':
+                    if digest:
+                        _upsert_daily(conn, user_id, key)
+                    else:
+                        # 購入の無い日の行は、週次・月次の作り直しと同じく削除する (0円の行を残さない)
+                        conn.execute(
+                            "DELETE FROM daily_summaries WHERE user_id = ? AND summary_date = ?",
+                            (user_id, key)
+                        )
+                else:
+                    needs_rebuild = True
+            if digest:
+                new_verified.append((user_id, period_type, key) + digest)
+            else:
+                conn.execute(
+                    "DELETE FROM verified_digests WHERE user_id = ? AND period_type = ? AND period_key = ?",
+                    (user_id, period_type, key)
+                )
+
+    if needs_rebuild:
+        rebuild_summaries(conn, user_id, month_first, month_last)
+    conn.executemany(f"""
+        INSERT OR REPLACE INTO verified_digests
+            (user_id, period_type, period_key, {', '.join(_DIGEST_COLUMNS)})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, new_verified)
+    return checked, repaired
+
+
+def check_user(db_path, user_id, full=False):
+    """
+    1ユーザー分のチェックと修復を行う
+    変わった月の洗い出しは読み込みだけで行う。変わった月があれば、修復が要らなくても
+    検証済みダイジェストを書き換えるので書き込みロックを取る (購入の追加後は毎回取ることになる)。
+    ダイジェストが前回検証時から1か月も変わっていなければ、ロックは取らずに終わる
+    戻り値: (検証した期間数, 修復した期間数)
+    """
+    conn = connect(db_path)
+    try:
+        months = _changed_months(conn, user_id, full)
+        if not months:
+            return 0, 0
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 変わった月を含む範囲をまとめて検証する
+            month_first, month_last = month_bounds(conn, f"{months[0]}-01", f"{months[-1]}-01")
+            result = _verify_range(conn, user_id, month_first, month_last, full)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.close()
+
+
+def check_all(db_paths, full=False, workers=4, sample=SAMPLE_RATE):
+    """
+    全ユーザーをユーザー単位で並列にチェックする。戻り値は集計結果の辞書
+    full でなければ、sample の割合で選んだユーザーだけ全期間を検証する
+    (差分チェックでは見つからない、集計テーブル側だけのずれを拾うため)
+    """
+    tasks = []
+    for path in db_paths:
+        conn = connect(path, read_only=True)
+        user_ids = [row[0] for row in conn.execute("""
+            SELECT user_id FROM day_digests
+            UNION SELECT user_id FROM daily_summaries
+            UNION SELECT user_id FROM weekly_summaries
+            UNION SELECT user_id FROM monthly_summaries
+        """)]
+        conn.close()
+        tasks += [(path, user_id, full or random.random() < sample) for user_id in user_ids]
+
+    report = {'users': len(tasks), 'full_users': sum(t[2] for t in tasks), 'checked': 0, 'repaired': 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for checked, repaired in pool.map(lambda t: check_user(*t), tasks):
+            report['checked'] += checked
+            report['repaired'] += repaired
+    return report
+
+
+def main():
+    from . import DB_PATH
+    from .shard import data_db_paths
+
+    parser = argparse.ArgumentParser(description="集計テーブルと購入データの整合性チェック")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser(
+        'check', help="ずれている集計を見つけて修復する",
+        description="既定では購入が変わった期間だけを検証する。集計テーブルだけが書き換えられた・壊れた"
+                    "ずれは見つからないので、--full も定期的に実行すること",
+    )
+    p.add_argument('db_path', nargs='?', default=DB_PATH,
+                   help="対象のDB (シャーディング時は全シャードを処理する)")
+    p.add_argument('--full', action='store_true', help="全ユーザーの、ダイジェストが変わっていない期間も検証する")
+    p.add_argument('--sample', type=float, default=SAMPLE_RATE,
+                   help=f"差分チェックのときに全期間を検証するユーザーの割合 (既定: {SAMPLE_RATE})")
+    p.add_argument('--workers', type=int, default=4, help="並列に処理するユーザー数")
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        report = check_all(data_db_paths(args.db_path), full=args.full, workers=args.workers, sample=args.sample)
+        print(f"users: {report['users']} (full: {report['full_users']}), "
+              f"periods checked: {report['checked']}, repaired: {report['repaired']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+1年分の日別支出 (カレンダー型ヒートマップ) の取得とキャッシュ
+
+get_daily_summary を365回呼ぶ代わりに、その年の daily_summaries を
+(user_id, summary_date) のインデックスで1回の範囲検索だけで読み、
+1月1日からの日数を添字にした長さ365/366の整数配列にして返す。
+時間帯別の内訳は daily_summaries に無いので、必要なときだけ purchases を同じく1回の範囲検索で読む。
+
+結果は (user_id, 年) ごとにキャッシュし、購入の追加時に invalidate_heatmap() で捨てる。
+キャッシュはプロセスごとなので、他のワーカーでの追加分は CACHE_TTL 秒で反映される。
+"""
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+# 指定できる内訳
+BREAKDOWNS = ('category', 'time_period')
+
+# キャッシュの有効期間 (秒) と最大件数
+CACHE_TTL = 300
+CACHE_MAX_ENTRIES = 1024
+
+# daily_summaries の列 -> 内訳のキー
+_CATEGORY_COLUMNS = (
+    ('drink_total', 'drink'),
+    ('snack_total', 'snack'),
+    ('main_dish_total', 'main'),
+    ('irregular_total', 'irregular'),
+)
+
+_TIME_PERIODS = ('朝', '昼', '晩')
+
+
+def year_range(year):
+    """(1月1日, 12月31日, 日数) を返す"""
+    first = datetime.date(year, 1, 1)
+    last = datetime.date(year, 12, 31)
+    return first, last, (last - first).days + 1
+
+
+def _day_index(date_str, first):
+    return (datetime.date.fromisoformat(date_str) - first).days
+
+
+def fetch_daily_heatmap(conn, user_id, year):
+    """
+    その年の日別合計とカテゴリ別内訳を1本のSQLで読み、
+    {'totals': [...], 'categories': {'drink': [...], ...}} を返す (配列は1月1日始まり)
+    """
+    first, last, days = year_range(year)
+    totals = [0] * days
+    categories = {key: [0] * days for _, key in _CATEGORY_COLUMNS}
+
+    rows = conn.execute("""
+        SELECT summary_date, daily_total, drink_total, snack_total, main_dish_total, irregular_total
+        FROM daily_summaries
+        WHERE user_id = ? AND summary_date BETWEEN ? AND ?
+    """, (user_id, first.isoformat(), last.isoformat()))
+    for row in rows:
+        i = _day_index(row['summary_date'], first)
+        totals[i] = row['daily_total'] or 0
+        for col, key in _CATEGORY_COLUMNS:
+            categories[key][i] = row[col] or 0
+    return {'totals': totals, 'categories': categories}
+
+
+def fetch_time_period_heatmap(conn, user_id, year):
+    """その年の時間帯別の日別合計を purchases の1回の範囲検索で集計する ({'朝': [...], ...})"""
+    first, last, days = year_range(year)
+    periods = {period: [0] * days for period in _TIME_PERIODS}
+
+    rows = conn.execute("""
+        SELECT purchase_date, time_period,
+               SUM(drink_amount + snack_amount + main_dish_amount + irregular_amount) AS subtotal
+        FROM purchases
+        WHERE user_id = ? AND purchase_date BETWEEN ? AND ?
+        GROUP BY purchase_date, time_period
+    """, (user_id, first.isoformat(), last.isoformat()))
+    for row in rows:
+        if row['time_period'] in periods:
+            periods[row['time_period']][_day_index(row['purchase_date'], first)] = row['subtotal'] or 0
+    return periods
+
+
+# --- キャッシュ ---
+# (user_id, year) -> (作成時刻, {'totals': ..., 'categories': ..., 'time_periods': ...})
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# 読み込み中の (user_id, year) -> [読み込み中の数, 読み込み中に無効化した回数]
+# 読み込み中に無効化された結果をキャッシュしないためのもので、読み込みが終われば消すので大きくならない
+_loading = {}
+
+
+def get_year_heatmap(open_conn, user_id, year, breakdowns=()):
+    """
+    その年のヒートマップをキャッシュ経由で返す
+    open_conn: キャッシュに無いときだけ呼ぶ、接続を返す関数
+    breakdowns: BREAKDOWNS のうち含める内訳
+    """
+    now = time.monotonic()
+    key = (user_id, year)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and now - entry[0] > CACHE_TTL:
+            del _cache[key]
+            entry = None
+        parts = dict(entry[1]) if entry is not None else {}
+        created = entry[0] if entry is not None else now
+
+        need_daily = 'totals' not in parts
+        need_periods = 'time_period' in breakdowns and 'time_periods' not in parts
+        if need_daily or need_periods:
+            loading = _loading.setdefault(key, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+
+    if need_daily or need_periods:
+        loaded = False
+        try:
+            conn = open_conn()
+            try:
+                if need_daily:
+                    parts.update(fetch_daily_heatmap(conn, user_id, year))
+                if need_periods:
+                    parts['time_periods'] = fetch_time_period_heatmap(conn, user_id, year)
+            finally:
+                conn.close()
+            loaded = True
+        finally:
+            with _cache_lock:
+                loading[0] -= 1
+                if loading[0] == 0:
+                    del _loading[key]
+                if loaded and loading[1] == generation:
+                    _cache[key] = (created, parts)
+                    _cache.move_to_end(key)
+                    while len(_cache) > CACHE_MAX_ENTRIES:
+                        _cache.popitem(last=False)
+    else:
+        with _cache_lock:
+            if key in _cache:
+                _cache.move_to_end(key)
+
+    first, _, days = year_range(year)
+    result = {
+        'year': year,
+        'start': first.isoformat(),
+        'days': days,
+        'max': max(parts['totals']),
+        'totals': parts['totals'],
+    }
+    if 'category' in breakdowns:
+        result['categories'] = parts['categories']
+    if 'time_period' in breakdowns:
+        result['time_periods'] = parts['time_periods']
+    return result
+
+
+def invalidate_heatmap(user_id, year):
+    """購入の追加・変更時に、その (user_id, 年) のキャッシュを捨てる"""
+    with _cache_lock:
+        _cache.pop((user_id, year), None)
+        loading = _loading.get((user_id, year))
+        if loading is not None:
+            loading[1] += 1
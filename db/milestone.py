@@ -0,0 +1,134 @@
+"""
+缶バッジ換算の節目 (マイルストーン) の記録
+
+月次集計が変わるたびに、変更前後のバッジ換算数 (monthly_total // バッジ単価) を比べ、
+節目を越えたときだけ badge_milestones にイベントを追記する。
+通知やフィードはこの表を読むだけでよく、全ユーザーの月合計を見て回る必要がない。
+
+- 1つの月で同じ節目のイベントは1回だけ (下回ってから再び越えても追加しない)
+- 記録するのは購入による変化だけ。バッジ単価の変更で換算数が変わってもイベントにはしない
+"""
+from .pagination import clamp_page_size
+
+# 節目のバッジ数 -> 痛バ画面に出すひとこと
+MILESTONES = (
+    (5, "「5個突破。あのご飯を我慢してれば、今頃手元にバッジがあったのに...」"),
+    (10, "「10個分。無駄に食べて還元されるのは、カードの請求と脂肪だけ。」"),
+    (20, "「20個...推しへの投資は、食への投資より美容に良い（はず）。」"),
+    (30, "「30個突破...もうあきらめて1面組む？それとも次こそ弁当作る？」"),
+    (40, "「1面完成...おめでとう。でもこれ、全部胃袋に消えたはずのお金なんだよね...？」"),
+)
+# 節目に届いていないときのひとこと
+FIRST_MESSAGE = "「まだ数個分。今なら引き返せる！明日からお弁当にしよう！」"
+
+_MILESTONE_DDL = """
+CREATE TABLE IF NOT EXISTS badge_milestones (
+    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    milestone INTEGER NOT NULL, -- 越えた節目のバッジ数
+    badges INTEGER NOT NULL,    -- 越えた時点のバッジ換算数
+    created_at TEXT DEFAULT (DATETIME('now', 'localtime')),
+    UNIQUE(user_id, year, month, milestone)
+);
+-- ユーザーごとのフィード (新しい順) 用
+CREATE INDEX IF NOT EXISTS idx_badge_milestones_user ON badge_milestones(user_id, event_id);
+"""
+
+
+def ensure_milestone_tables(conn):
+    """イベント用のテーブルを作成し、新規作成時は既存の月次集計から到達済みの節目を埋める"""
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'badge_milestones'"
+    ).fetchone() is None
+    conn.executescript(_MILESTONE_DDL)
+    if created:
+        from .badge_setting import DEFAULT_BADGE_PRICE
+
+        thresholds = " UNION ALL ".join(f"SELECT {m} AS milestone" for m, _ in MILESTONES)
+        with conn:
+            conn.execute(f"""
+                INSERT OR IGNORE INTO badge_milestones (user_id, year, month, milestone, badges)
+                SELECT user_id, year, month, t.milestone, badges
+                FROM (
+                    -- percentile.badge_count() と同じ規則: 設定行が無ければ既定の単価、単価が0以下なら0個
+                    SELECT m.user_id, m.year, m.month,
+                           CASE WHEN price > 0 THEN CAST(COALESCE(m.monthly_total, 0) / price AS INTEGER) ELSE 0 END
+                               AS badges
+                    FROM (
+                        SELECT m.*, CASE WHEN s.user_id IS NULL THEN ? ELSE s.badge_price END AS price
+                        FROM monthly_summaries m
+                        LEFT JOIN badge_settings s ON s.user_id = m.user_id
+                    ) AS m
+                )
+                JOIN ({thresholds}) AS t ON badges >= t.milestone
+                ORDER BY user_id, year, month, t.milestone
+            """, (DEFAULT_BADGE_PRICE,))
+
+
+def crossed_milestones(old_badges, new_badges):
+    """old_badges -> new_badges で新たに越えた節目のリスト"""
+    return [m for m, _ in MILESTONES if old_badges < m <= new_badges]
+
+
+def record_milestones(conn, user_id, year, month, old_badges, new_badges):
+    """
+    月のバッジ換算数が old_badges -> new_badges に変わったときに、越えた節目をイベントとして追記する
+    追記した件数を返す。コミットは呼び出し側で行う
+    """
+    crossed = crossed_milestones(old_badges, new_badges)
+    if not crossed:
+        return 0
+    conn.executemany("""
+        INSERT OR IGNORE INTO badge_milestones (user_id, year, month, milestone, badges)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(user_id, year, month, m, new_badges) for m in crossed])
+    return len(crossed)
+
+
+def milestone_message(badges):
+    """到達している一番大きい節目のひとことを返す"""
+    message = FIRST_MESSAGE
+    for milestone, text in MILESTONES:
+        if badges >= milestone:
+            message = text
+    return message
+
+
+def milestone_class(badges):
+    """
+    痛バ画面でひとことに付ける CSS クラス
+    最初の節目の手前なら緑、最後の節目 (1面完成) に届いたら赤字で強調する
+    """
+    if badges >= MILESTONES[-1][0]:
+        return "text-danger fw-bold"
+    if badges < MILESTONES[0][0]:
+        return "text-success"
+    return ""
+
+
+def fetch_milestone_feed(conn, user_id, before=None, limit=None):
+    """
+    ユーザーの節目イベントを新しい順に1ページ分返す (キーセット方式)
+    before: 前ページの next_cursor (event_id)。戻り値: (rows, next_cursor)
+    """
+    limit = clamp_page_size(limit)
+    sql = """
+        SELECT event_id, year, month, milestone, badges, created_at
+        FROM badge_milestones
+        WHERE user_id = ?
+    """
+    params = [user_id]
+    if before is not None:
+        sql += " AND event_id < ?"
+        params.append(int(before))
+    sql += " ORDER BY event_id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]['event_id']
+    return rows, next_cursor
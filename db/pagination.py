@@ -0,0 +1,62 @@
+"""
+キーセット(カーソル)方式のページング用ヘルパー
+
+OFFSET を使うと深いページほど読み飛ばす行が増えて遅くなるため、
+「前のページの最後の行のキー」を覚えておき、その続きから読む。
+購入履歴のキーは (purchase_date, purchase_id) の組み合わせ。
+"""
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(purchase_date, purchase_id):
+    """(日付, ID) をURLに載せられる文字列 'YYYY-MM-DD_123' にする"""
+    return f"{purchase_date}_{purchase_id}"
+
+
+def decode_cursor(cursor):
+    """
+    encode_cursor で作った文字列を (日付, ID) に戻す
+    不正な値の場合は ValueError を送出する
+    """
+    date_part, sep, id_part = cursor.rpartition('_')
+    if not sep or len(date_part) != 10:
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    return date_part, int(id_part)
+
+
+def clamp_page_size(limit):
+    """ページサイズを 1〜MAX_PAGE_SIZE の範囲に収める (None ならデフォルト)"""
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def fetch_purchase_keyset_page(conn, sql, params, cursor=None, limit=None, table_alias=None):
+    """
+    購入を (purchase_date, purchase_id) の新しい順に1ページ分読む
+    sql: WHERE 句まで組み立てた SELECT (purchase_date と purchase_id の列を含めること)
+    table_alias: purchases に別名を付けている場合はその名前 ('p' など)
+    戻り値: (rows, next_cursor)  次ページが無い場合 next_cursor は None
+    不正なカーソルなら ValueError
+    """
+    limit = clamp_page_size(limit)
+    prefix = f"{table_alias}." if table_alias else ""
+    params = list(params)
+    if cursor:
+        last_date, last_id = decode_cursor(cursor)
+        # (日付, ID) が前ページの最後の行より「古い」ものだけを読む
+        sql += f" AND ({prefix}purchase_date, {prefix}purchase_id) < (?, ?)"
+        params += [last_date, last_id]
+    sql += f" ORDER BY {prefix}purchase_date DESC, {prefix}purchase_id DESC LIMIT ?"
+    # 1件多めに読んで次ページの有無を判定する
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last['purchase_date'], last['purchase_id'])
+    return rows, next_cursor
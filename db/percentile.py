@@ -0,0 +1,202 @@
+"""
+全ユーザー中での支出の順位 (パーセンタイル) を求めるためのスケッチ
+
+ページを開くたびに monthly_summaries を全件ソートする代わりに、
+(年, 月, 指標) ごとに「値を対数スケールのバケットに分けた件数表」を持っておき、
+月次集計が変わるたびに古い値のバケットを -1、新しい値のバケットを +1 する。
+
+- バケット境界は gamma = (1 + ALPHA) / (1 - ALPHA) のべき乗 (DDSketch と同じ方式)
+- 件数を足し合わせるだけでマージできるので、シャードごとのスケッチもそのまま合算できる
+- 順位の問い合わせはバケット数 (1円〜1億円で約900個) の範囲集計だけで、ユーザー数に依存しない
+
+誤差の保証:
+    同じバケットに入るのは値が相対誤差 ALPHA 以内のユーザーだけなので、
+    返すパーセンタイルの誤差は「その値の ±ALPHA 以内にいるユーザーの割合の半分」以下。
+    (ALPHA = 0.01 なら、1万円に対して 9,900〜10,100円付近のユーザー分だけずれうる)
+
+スケッチの作り直し (バッチ):
+    python -m db.percentile rebuild
+"""
+import argparse
+import math
+
+# 相対誤差
+ALPHA = 0.01
+_GAMMA = (1 + ALPHA) / (1 - ALPHA)
+_LOG_GAMMA = math.log(_GAMMA)
+
+# 0円以下の値を入れるバケット (1円以上はバケット番号 0 以上になる)
+ZERO_BUCKET = -1
+
+# 指標名 -> monthly_summaries の列名 ('badges' だけは換算値)
+METRICS = ('monthly_total', 'drink_total', 'snack_total', 'main_dish_total', 'irregular_total', 'badges')
+
+_SKETCH_DDL = """
+CREATE TABLE IF NOT EXISTS percentile_buckets (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (year, month, metric, bucket)
+) WITHOUT ROWID;
+"""
+
+
+def ensure_percentile_tables(conn):
+    """スケッチ用のテーブルが無ければ作成する"""
+    conn.executescript(_SKETCH_DDL)
+
+
+def bucket_index(value):
+    """値が入るバケット番号を返す"""
+    if value is None or value <= 0:
+        return ZERO_BUCKET
+    return math.ceil(math.log(value) / _LOG_GAMMA)
+
+
+def badge_count(monthly_total, badge_price):
+    """
+    月の合計金額をバッジ何個分かに換算する (単価が0以下・未設定なら0個)
+    スケッチ・節目イベント・痛バ画面はすべてこの規則で数える
+    """
+    if not badge_price or badge_price <= 0:
+        return 0
+    return int((monthly_total or 0) // badge_price)
+
+
+def metric_values(row, badge_price):
+    """monthly_summaries の行から各指標の値を取り出す (行が無ければ None)"""
+    if row is None:
+        return None
+    values = {m: row[m] or 0 for m in METRICS if m != 'badges'}
+    values['badges'] = badge_count(values['monthly_total'], badge_price)
+    return values
+
+
+def update_sketches(conn, year, month, old_values, new_values):
+    """
+    あるユーザーの (year, month) の値が old_values -> new_values に変わったことを反映する
+    どちらも metric_values() の戻り値 (集計行が無かった/消えた場合は None)
+    コミットは呼び出し側で行う
+    """
+    changes = {}
+    for metric in METRICS:
+        if old_values is not None:
+            key = (metric, bucket_index(old_values[metric]))
+            changes[key] = changes.get(key, 0) - 1
+        if new_values is not None:
+            key = (metric, bucket_index(new_values[metric]))
+            changes[key] = changes.get(key, 0) + 1
+
+    for (metric, bucket), delta in changes.items():
+        if delta == 0:
+            continue
+        conn.execute("""
+            INSERT INTO percentile_buckets (year, month, metric, bucket, count)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(year, month, metric, bucket) DO UPDATE SET count = count + excluded.count
+        """, (year, month, metric, bucket, delta))
+
+
+def rerate_badge_sketch(conn, user_id, old_badge_price, new_badge_price):
+    """
+    バッジ単価の変更に合わせて、あるユーザーの全月の 'badges' 指標を付け替える
+    月の数だけループせず、旧単価での件数を引く・新単価での件数を足す INSERT を1本ずつ流す
+    コミットは呼び出し側で行う
+    """
+    # バケット番号の計算は Python 側と同じ関数を使う (SQLite の数学関数の有無に依存しない)
+    conn.create_function('oshi_bucket_index', 1, bucket_index, deterministic=True)
+    for badge_price, sign in ((old_badge_price, -1), (new_badge_price, 1)):
+        # metric_values() の monthly_total // badge_price と同じ値 (金額は0以上の整数)
+        conn.execute("""
+            INSERT INTO percentile_buckets (year, month, metric, bucket, count)
+            SELECT year, month, 'badges',
+                   oshi_bucket_index(CASE WHEN ? > 0 THEN CAST(COALESCE(monthly_total, 0) / ? AS INTEGER) ELSE 0 END) AS b,
+                   ? * COUNT(*)
+            FROM monthly_summaries
+            WHERE user_id = ?
+            GROUP BY year, month, b
+            ON CONFLICT(year, month, metric, bucket) DO UPDATE SET count = count + excluded.count
+        """, (badge_price, badge_price, sign, user_id))
+
+
+def get_percentile(conns, year, month, metric, value):
+    """
+    (year, month) の全ユーザーのうち、value より少ない人の割合 (0〜100) を返す
+    conns: スケッチを持つ接続のリスト (シャーディング時は全シャード分を合算する)
+    データが無い場合は None
+    """
+    target = bucket_index(value)
+    below = same = total = 0
+    for conn in conns:
+        row = conn.execute("""
+            SELECT
+                SUM(CASE WHEN bucket < ? THEN count ELSE 0 END),
+                SUM(CASE WHEN bucket = ? THEN count ELSE 0 END),
+                SUM(count)
+            FROM percentile_buckets
+            WHERE year = ? AND month = ? AND metric = ?
+        """, (target, target, year, month, metric)).fetchone()
+        below += row[0] or 0
+        same += row[1] or 0
+        total += row[2] or 0
+    if total <= 0:
+        return None
+    # 同じバケット内の順位は分からないので真ん中とみなす
+    return 100.0 * (below + same / 2) / total
+
+
+def rebuild_sketches(conn, default_badge_price):
+    """monthly_summaries 全体からスケッチを作り直す (コミットまで行う)"""
+    # 作り直しの途中で書き込みが入って差分を取りこぼさないよう、先に書き込みロックを取る
+    conn.execute("BEGIN IMMEDIATE")
+    counts = {}
+    rows = conn.execute("""
+        SELECT m.*, s.badge_price
+        FROM monthly_summaries m
+        LEFT JOIN badge_settings s ON s.user_id = m.user_id
+    """)
+    for row in rows:
+        badge_price = row['badge_price'] if row['badge_price'] is not None else default_badge_price
+        values = metric_values(row, badge_price)
+        for metric in METRICS:
+            key = (row['year'], row['month'], metric, bucket_index(values[metric]))
+            counts[key] = counts.get(key, 0) + 1
+
+    try:
+        conn.execute("DELETE FROM percentile_buckets")
+        conn.executemany(
+            "INSERT INTO percentile_buckets (year, month, metric, bucket, count) VALUES (?, ?, ?, ?, ?)",
+            [key + (count,) for key, count in counts.items()]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(counts)
+
+
+def main():
+    from . import DB_PATH
+    from .shard import data_db_paths
+    from .badge_setting import DEFAULT_BADGE_PRICE
+
+    parser = argparse.ArgumentParser(description="支出パーセンタイル用スケッチの管理")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('rebuild', help="monthly_summaries からスケッチを作り直す")
+    p.add_argument('db_path', nargs='?', default=DB_PATH,
+                   help="対象のDB (シャーディング時は全シャードを処理する)")
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        for path in data_db_paths(args.db_path):
+            conn = connect(path)
+            ensure_percentile_tables(conn)
+            n = rebuild_sketches(conn, DEFAULT_BADGE_PRICE)
+            conn.close()
+            print(f"Rebuilt {n} buckets: {path}")
+
+
+if __name__ == '__main__':
+    main()
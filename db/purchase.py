@@ -1,14 +1,15 @@
 from . import get_db_connection
+from .pagination import fetch_purchase_keyset_page
+from .summary import refresh_summaries
+from .calendar import normalize_date
 from datetime import datetime
 
-def add_purchase(user_id, date_str, time_period, amounts, memo=""):
+def insert_purchase(conn, user_id, date_str, time_period, amounts, memo=""):
     """
-    購入データを追加する
+    渡された接続で購入データを1件INSERTし、purchase_id を返す (コミットはしない)
     amounts: {'drink': 100, 'snack': 200, ...} のような辞書を想定
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
+    cursor = conn.execute(
         """
         INSERT INTO purchases 
         (user_id, purchase_date, time_period, drink_amount, snack_amount, 
@@ -26,16 +27,79 @@ def add_purchase(user_id, date_str, time_period, amounts, memo=""):
             memo
         )
     )
+    return cursor.lastrowid
+
+def record_purchase(conn, user_id, date_str, time_period, amounts, memo=""):
+    """
+    購入の追加と日次・週次・月次集計の更新を1つのトランザクションで行い、purchase_id を返す
+    - トランザクション外で呼ぶと BEGIN IMMEDIATE で書き込みロックを先に取り、最後にコミットする
+      (同じユーザーへの同時追加で集計の読み込み→書き込みが入れ違わず、コミットも1回で済む)
+    - 呼び出し側のトランザクション内で呼ぶと SAVEPOINT で区切るだけで、コミットは呼び出し側で行う
+    失敗した場合はこの購入の分だけ巻き戻して例外を投げる
+    date_str は 'YYYY-MM-DD' にそろえてから保存する ('2025-3-5' -> '2025-03-05'。不正なら ValueError)
+    """
+    date_str = normalize_date(date_str)
+    if conn.in_transaction:
+        conn.execute("SAVEPOINT record_purchase")
+        try:
+            purchase_id = insert_purchase(conn, user_id, date_str, time_period, amounts, memo)
+            refresh_summaries(conn, user_id, date_str)
+        except Exception:
+            conn.execute("ROLLBACK TO record_purchase")
+            conn.execute("RELEASE record_purchase")
+            raise
+        conn.execute("RELEASE record_purchase")
+        return purchase_id
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        purchase_id = insert_purchase(conn, user_id, date_str, time_period, amounts, memo)
+        refresh_summaries(conn, user_id, date_str)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return purchase_id
+
+def add_purchase(user_id, date_str, time_period, amounts, memo=""):
+    """
+    購入データを追加する
+    amounts: {'drink': 100, 'snack': 200, ...} のような辞書を想定
+    """
+    conn = get_db_connection(user_id)
+    purchase_id = insert_purchase(conn, user_id, date_str, time_period, amounts, memo)
     conn.commit()
     conn.close()
-    return cursor.lastrowid
+    return purchase_id
 
 def get_purchases_by_date(user_id, date_str):
     """指定した日付の購入履歴を取得"""
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     rows = conn.execute(
         "SELECT * FROM purchases WHERE user_id = ? AND purchase_date = ?",
         (user_id, date_str)
     ).fetchall()
     conn.close()
-    return rows
\ No newline at end of file
+    return rows
+
+def fetch_purchase_page(conn, user_id, cursor=None, limit=None):
+    """
+    購入履歴を新しい順に1ページ分取得する (キーセット方式)
+    cursor: 前ページの next_cursor (None なら先頭ページ)
+    戻り値: (rows, next_cursor)  次ページが無い場合 next_cursor は None
+    """
+    sql = """
+        SELECT purchase_id, purchase_date, time_period, drink_amount, snack_amount,
+               main_dish_amount, irregular_amount, memo
+        FROM purchases
+        WHERE user_id = ?
+    """
+    return fetch_purchase_keyset_page(conn, sql, [user_id], cursor, limit)
+
+def get_purchase_page(user_id, cursor=None, limit=None):
+    """購入履歴を1ページ分取得 (fetch_purchase_page の接続付き版)"""
+    conn = get_db_connection(user_id)
+    try:
+        return fetch_purchase_page(conn, user_id, cursor, limit)
+    finally:
+        conn.close()
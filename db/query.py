@@ -0,0 +1,161 @@
+"""
+列を指定して読む問い合わせ層
+
+SELECT * で全列を sqlite3.Row として受け取る代わりに、呼び出し側が必要な列を名前で指定し、
+結果はその列だけを持つ軽いレコード (__slots__ = () のタプル) か、ただのタプルで返す。
+- 列名は TABLE_COLUMNS の一覧と照合するので、任意の文字列が SQL に入ることはない
+- レコードは row.daily_total でも row['daily_total'] でも読める (sqlite3.Row と同じ書き方のままでよい)
+- 一覧の取得には期間の上下限を指定でき、インデックスの範囲検索で必要な分だけ読む
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+# テーブル -> 読み出せる列
+TABLE_COLUMNS = {
+    'users': ('user_id', 'username', 'password_hash', 'created_at'),
+    'daily_summaries': (
+        'summary_id', 'user_id', 'summary_date', 'drink_total', 'snack_total', 'main_dish_total',
+        'irregular_total', 'daily_total', 'badge_equivalent', 'itabag_equivalent', 'updated_at',
+    ),
+    'weekly_summaries': (
+        'summary_id', 'user_id', 'start_date', 'end_date', 'drink_total', 'snack_total', 'main_dish_total',
+        'irregular_total', 'weekly_total', 'badge_equivalent', 'itabag_equivalent', 'updated_at',
+    ),
+    'monthly_summaries': (
+        'summary_id', 'user_id', 'year', 'month', 'drink_total', 'snack_total', 'main_dish_total',
+        'irregular_total', 'monthly_total', 'badge_equivalent', 'itabag_equivalent', 'updated_at',
+    ),
+}
+
+# 列を指定しなかったときの既定 (users は password_hash を含めない)
+USER_COLUMNS = ('user_id', 'username', 'created_at')
+DAILY_COLUMNS = ('summary_date', 'drink_total', 'snack_total', 'main_dish_total',
+                 'irregular_total', 'daily_total', 'badge_equivalent', 'itabag_equivalent')
+WEEKLY_COLUMNS = ('start_date', 'end_date', 'drink_total', 'snack_total', 'main_dish_total',
+                  'irregular_total', 'weekly_total', 'badge_equivalent', 'itabag_equivalent')
+MONTHLY_COLUMNS = ('year', 'month', 'drink_total', 'snack_total', 'main_dish_total',
+                   'irregular_total', 'monthly_total', 'badge_equivalent', 'itabag_equivalent')
+
+
+@lru_cache(maxsize=None)
+def record_type(columns):
+    """列名のタプルごとに、その列だけを持つレコード型を作る (同じ列の組なら同じ型を使い回す)"""
+    base = namedtuple('Record', columns)
+
+    class Record(base):
+        __slots__ = ()
+
+        def __getitem__(self, key):
+            # sqlite3.Row と同じく row['列名'] でも読めるようにする
+            if isinstance(key, str):
+                return getattr(self, key)
+            return tuple.__getitem__(self, key)
+
+        def keys(self):
+            return self._fields
+
+    return Record
+
+
+def _check_columns(table, columns):
+    columns = tuple(columns)
+    unknown = [c for c in columns if c not in TABLE_COLUMNS[table]]
+    if unknown or not columns:
+        raise ValueError(f"Unknown columns for {table}: {', '.join(unknown) or '(none)'}")
+    return columns
+
+
+def _range(where, params, column, start, end):
+    if start is not None:
+        where += f" AND {column} >= ?"
+        params.append(start)
+    if end is not None:
+        where += f" AND {column} <= ?"
+        params.append(end)
+    return where, params
+
+
+def select(conn, table, columns, where, params, order_by=None, as_tuple=False, one=False):
+    """
+    table から columns だけを読む
+    where / order_by は呼び出し側 (このモジュール内) で組み立てた固定の SQL 片
+    as_tuple=True ならただのタプル、そうでなければ record_type() のレコードで返す
+    """
+    columns = _check_columns(table, columns)
+    sql = f"SELECT {', '.join(columns)} FROM {table} WHERE {where}"
+    if order_by:
+        sql += f" ORDER BY {order_by}"
+
+    # 接続側の Row ファクトリは使わず、タプルのまま受け取ってからレコードにする
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(sql, params)
+    if one:
+        row = cursor.fetchone()
+        if row is None or as_tuple:
+            return row
+        return record_type(columns)._make(row)
+    rows = cursor.fetchall()
+    if as_tuple:
+        return rows
+    make = record_type(columns)._make
+    return [make(row) for row in rows]
+
+
+# --- ユーザー ---
+def fetch_user_by_username(conn, username, columns=USER_COLUMNS):
+    """ユーザー名からユーザーを取得 (ログイン時だけ password_hash を指定して読む)"""
+    return select(conn, 'users', columns, "username = ?", (username,), one=True)
+
+
+def fetch_user_by_id(conn, user_id, columns=USER_COLUMNS):
+    """IDからユーザーを取得"""
+    return select(conn, 'users', columns, "user_id = ?", (user_id,), one=True)
+
+
+# --- 集計 ---
+def fetch_daily_summary(conn, user_id, date_str, columns=DAILY_COLUMNS):
+    """1日分の日次集計 (無ければ None)"""
+    return select(conn, 'daily_summaries', columns,
+                  "user_id = ? AND summary_date = ?", (user_id, date_str), one=True)
+
+
+def fetch_daily_summaries(conn, user_id, start_date=None, end_date=None, columns=DAILY_COLUMNS, as_tuple=False):
+    """start_date〜end_date (省略時は上限・下限なし) の日次集計を日付順に返す"""
+    where, params = _range("user_id = ?", [user_id], "summary_date", start_date, end_date)
+    return select(conn, 'daily_summaries', columns, where, params, "summary_date", as_tuple)
+
+
+def fetch_weekly_summary(conn, user_id, date_str, columns=WEEKLY_COLUMNS):
+    """date_str を含む週の週次集計 (無ければ None)"""
+    return select(conn, 'weekly_summaries', columns,
+                  "user_id = ? AND start_date = (SELECT week_start FROM calendar WHERE cal_date = ?)",
+                  (user_id, date_str), one=True)
+
+
+def fetch_weekly_summaries(conn, user_id, start_date=None, end_date=None, columns=WEEKLY_COLUMNS, as_tuple=False):
+    """開始日が start_date〜end_date の週次集計を開始日順に返す"""
+    where, params = _range("user_id = ?", [user_id], "start_date", start_date, end_date)
+    return select(conn, 'weekly_summaries', columns, where, params, "start_date", as_tuple)
+
+
+def fetch_monthly_summary(conn, user_id, year, month, columns=MONTHLY_COLUMNS):
+    """ある月の月次集計 (無ければ None)"""
+    return select(conn, 'monthly_summaries', columns,
+                  "user_id = ? AND year = ? AND month = ?", (user_id, year, month), one=True)
+
+
+def fetch_monthly_summaries(conn, user_id, start=None, end=None, columns=MONTHLY_COLUMNS, as_tuple=False):
+    """
+    start〜end の月次集計を年月順に返す
+    start / end は (year, month) のタプル (省略時は上限・下限なし)
+    """
+    where, params = "user_id = ?", [user_id]
+    # (year, month) の行値比較なら UNIQUE(user_id, year, month) のインデックスで範囲検索できる
+    if start is not None:
+        where += " AND (year, month) >= (?, ?)"
+        params += list(start)
+    if end is not None:
+        where += " AND (year, month) <= (?, ?)"
+        params += list(end)
+    return select(conn, 'monthly_summaries', columns, where, params, "year, month", as_tuple)
@@ -44,6 +44,9 @@ CREATE TABLE purchases (
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
 );
 
+-- 購入履歴のキーセットページング用 (user_id ごとに日付・ID順で辿る)
+CREATE INDEX idx_purchases_user_date ON purchases(user_id, purchase_date, purchase_id);
+
 -- -----------------------------------------------------
 -- 4. daily_summariesテーブル
 -- -----------------------------------------------------
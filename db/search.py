@@ -0,0 +1,128 @@
+"""
+購入メモの全文検索 (FTS5)
+
+memo を LIKE '%...%' で探すと purchases を全件読むことになるので、
+FTS5 の trigram (3文字ずつ区切る) 索引を用意し、purchases のトリガーで同期する。
+日本語は単語の区切りが無いので、分かち書き不要の trigram を使う。
+
+- 索引には memo のほかに所有者 '<user_id>' も入れ、MATCH の中でユーザーを絞り込む
+  (他のユーザーの一致行を読んでから捨てることがない)
+- 3文字未満の語は trigram で引けないので、そのユーザーの行に限って LIKE で絞る
+- 結果は購入履歴と同じく (日付, ID) の新しい順で、キーセット方式でページングする
+"""
+from .pagination import fetch_purchase_keyset_page
+
+# trigram で索引を引ける最短の長さ
+MIN_TERM_LENGTH = 3
+
+_SEARCH_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS purchase_memo_fts USING fts5(
+    owner, memo, content='', tokenize='trigram'
+);
+
+CREATE TRIGGER IF NOT EXISTS trigger_purchases_fts_insert
+AFTER INSERT ON purchases
+WHEN NEW.memo IS NOT NULL AND NEW.memo != ''
+BEGIN
+    INSERT INTO purchase_memo_fts (rowid, owner, memo)
+    VALUES (NEW.purchase_id, '<' || NEW.user_id || '>', NEW.memo);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trigger_purchases_fts_delete
+AFTER DELETE ON purchases
+WHEN OLD.memo IS NOT NULL AND OLD.memo != ''
+BEGIN
+    INSERT INTO purchase_memo_fts (purchase_memo_fts, rowid, owner, memo)
+    VALUES ('delete', OLD.purchase_id, '<' || OLD.user_id || '>', OLD.memo);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trigger_purchases_fts_update
+AFTER UPDATE OF memo, user_id ON purchases
+BEGIN
+    INSERT INTO purchase_memo_fts (purchase_memo_fts, rowid, owner, memo)
+    SELECT 'delete', OLD.purchase_id, '<' || OLD.user_id || '>', OLD.memo
+    WHERE OLD.memo IS NOT NULL AND OLD.memo != '';
+    INSERT INTO purchase_memo_fts (rowid, owner, memo)
+    SELECT NEW.purchase_id, '<' || NEW.user_id || '>', NEW.memo
+    WHERE NEW.memo IS NOT NULL AND NEW.memo != '';
+END;
+"""
+
+# 検索結果の列 (購入履歴と同じ)
+_RESULT_COLUMNS = """
+    p.purchase_id, p.purchase_date, p.time_period, p.drink_amount, p.snack_amount,
+    p.main_dish_amount, p.irregular_amount, p.memo
+"""
+
+
+def ensure_search_tables(conn):
+    """検索索引とトリガーを作成し、新規作成時は既存の購入メモから索引を作る"""
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'purchase_memo_fts'"
+    ).fetchone() is None
+    conn.executescript(_SEARCH_DDL)
+    if created:
+        with conn:
+            conn.execute("""
+                INSERT INTO purchase_memo_fts (rowid, owner, memo)
+                SELECT purchase_id, '<' || user_id || '>', memo
+                FROM purchases
+                WHERE memo IS NOT NULL AND memo != ''
+            """)
+
+
+def _quote(term):
+    """FTS5 の文字列リテラルにする (" は2つ重ねる)"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like_pattern(term):
+    """LIKE 用に % _ \\ をエスケープする"""
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def search_purchases(conn, user_id, query, start_date=None, end_date=None, cursor=None, limit=None):
+    """
+    メモに query の語をすべて含む購入を新しい順に1ページ分返す
+    query: 空白区切りの語 (AND 検索)
+    start_date / end_date: 購入日の範囲 (省略時は制限なし)
+    cursor: 前ページの next_cursor。戻り値: (rows, next_cursor)
+    語が無い・カーソルが不正な場合は ValueError
+    """
+    terms = query.split()
+    if not terms:
+        raise ValueError("empty query")
+
+    long_terms = [t for t in terms if len(t) >= MIN_TERM_LENGTH]
+    short_terms = [t for t in terms if len(t) < MIN_TERM_LENGTH]
+
+    params = []
+    if long_terms:
+        match = f"owner:{_quote(f'<{user_id}>')} AND " + " AND ".join(f"memo:{_quote(t)}" for t in long_terms)
+        sql = f"""
+            SELECT {_RESULT_COLUMNS}
+            FROM purchase_memo_fts f
+            JOIN purchases p ON p.purchase_id = f.rowid
+            WHERE purchase_memo_fts MATCH ? AND p.user_id = ?
+        """
+        params += [match, user_id]
+    else:
+        # 短い語だけなら索引は使えないので、そのユーザーの行 (user_id のインデックス) だけを LIKE で見る
+        sql = f"""
+            SELECT {_RESULT_COLUMNS}
+            FROM purchases p
+            WHERE p.user_id = ?
+        """
+        params.append(user_id)
+
+    for term in short_terms:
+        sql += " AND p.memo LIKE ? ESCAPE '\\'"
+        params.append(_like_pattern(term))
+    if start_date:
+        sql += " AND p.purchase_date >= ?"
+        params.append(start_date)
+    if end_date:
+        sql += " AND p.purchase_date <= ?"
+        params.append(end_date)
+    return fetch_purchase_keyset_page(conn, sql, params, cursor, limit, table_alias='p')
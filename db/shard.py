@@ -0,0 +1,135 @@
+"""
+ユーザー単位のデータベース分割 (シャーディング)
+
+SQLite はファイル単位で書き込みロックを取るため、全ユーザーが1ファイルを
+共有すると /insert がすべて1本のロックに並んでしまう。
+環境変数 OSHI_SHARD_COUNT に 1 以上を指定すると、ユーザーごとのデータ
+(購入・集計・設定) を user_id のハッシュで選んだ N 個のシャードファイルに置き、
+元のファイルは users だけを持つ「ディレクトリDB」として使う。
+
+既存の1ファイル構成からの移行:
+    python -m db.shard reshard oshikatsu.db 4
+"""
+import argparse
+import os
+
+# 0 ならシャーディングなし (従来どおり1ファイル)
+SHARD_COUNT = int(os.environ.get('OSHI_SHARD_COUNT', '0'))
+
+# user_id を持ち、シャードに振り分けるテーブル
+USER_TABLES = (
+    'badge_settings',
+    'purchases',
+    'daily_summaries',
+    'weekly_summaries',
+    'monthly_summaries',
+    'verified_digests',
+    'badge_milestones',
+)
+# day_digests と purchase_memo_fts は purchases のトリガーで、percentile_buckets は分割後に作り直すのでコピーしない
+
+
+def shard_index(user_id, shard_count=None):
+    """user_id から担当シャード番号を決める (SQL側の user_id % N と一致させる)"""
+    shard_count = shard_count or SHARD_COUNT
+    return int(user_id) % shard_count
+
+
+def shard_path(base_path, index):
+    """'oshikatsu.db' -> 'oshikatsu.shard0.db' のようなシャードファイル名を返す"""
+    root, ext = os.path.splitext(base_path)
+    return f"{root}.shard{index}{ext}"
+
+
+def resolve_db_path(base_path, user_id=None, shard_count=None):
+    """
+    接続先のファイルパスを決める
+    シャーディング無効、または user_id なし (users の参照など) ならディレクトリDB
+    """
+    shard_count = SHARD_COUNT if shard_count is None else shard_count
+    if not shard_count or user_id is None:
+        return base_path
+    return shard_path(base_path, shard_index(user_id, shard_count))
+
+
+def data_db_paths(base_path, shard_count=None):
+    """ユーザーデータを持つ全ファイルのパス (全ユーザー横断の処理用)"""
+    shard_count = SHARD_COUNT if shard_count is None else shard_count
+    if not shard_count:
+        return [base_path]
+    return [shard_path(base_path, i) for i in range(shard_count)]
+
+
+def reshard(base_path, shard_count, schema_path):
+    """
+    1ファイル構成のDBをシャードに分割する
+    ユーザーデータを各シャードへコピーした後、元ファイルからは削除して
+    users だけが残るディレクトリDBにする
+    """
+    from . import ensure_schema
+    from .storage import connect
+
+    paths = data_db_paths(base_path, shard_count)
+    for path in paths:
+        if os.path.exists(path):
+            raise FileExistsError(f"Shard already exists: {path}")
+
+    src = connect(base_path)
+    try:
+        # 古いDBには後から追加したテーブル (verified_digests など) が無いので、先に最新のスキーマにしておく
+        ensure_schema(src, schema_path)
+        for i, path in enumerate(paths):
+            # 空のシャードにスキーマを作り、user_version も記録する
+            # (記録しないと、起動時の init_db_if_needed が各シャードで更新とバックフィルをやり直す)
+            dst = connect(path)
+            ensure_schema(dst, schema_path)
+            dst.close()
+
+            src.execute("ATTACH DATABASE ? AS shard", (path,))
+            with src:
+                for table in USER_TABLES:
+                    src.execute(
+                        f"INSERT INTO shard.{table} SELECT * FROM main.{table} WHERE user_id % ? = ?",
+                        (shard_count, i)
+                    )
+            src.execute("DETACH DATABASE shard")
+            print(f"Shard {i} written: {path}")
+
+        # 全シャードへのコピーが終わってから元ファイルのユーザーデータを消す
+        with src:
+            for table in USER_TABLES:
+                src.execute(f"DELETE FROM main.{table}")
+            # ディレクトリDBに残ったスケッチは分割前の全ユーザー分なので捨てる (各シャードで作り直す)
+            src.execute("DELETE FROM main.percentile_buckets")
+        src.execute("VACUUM")
+    finally:
+        src.close()
+
+    # 全ユーザー横断のスケッチはシャードごとに作り直す
+    from .percentile import rebuild_sketches
+    from .badge_setting import DEFAULT_BADGE_PRICE
+    for path in paths:
+        dst = connect(path)
+        rebuild_sketches(dst, DEFAULT_BADGE_PRICE)
+        dst.close()
+    print(f"Resharded {base_path} into {shard_count} shards. "
+          f"Set OSHI_SHARD_COUNT={shard_count} before starting the server.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ユーザーデータのシャード分割ツール")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('reshard', help="1ファイル構成のDBをN個のシャードに分割する")
+    p.add_argument('db_path')
+    p.add_argument('shards', type=int)
+    p.add_argument('--schema', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'))
+    args = parser.parse_args()
+
+    if args.command == 'reshard':
+        if args.shards < 1:
+            parser.error("shards must be >= 1")
+        reshard(args.db_path, args.shards, args.schema)
+
+
+if __name__ == '__main__':
+    main()
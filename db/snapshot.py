@@ -0,0 +1,271 @@
+"""
+purchases の列指向スナップショット (分析・バッチ集計用)
+
+バッチ集計で purchases を sqlite3.Row として1行ずつ読む代わりに、
+列ごとに1ファイルの固定長バイナリ (NumPy 配列) として書き出しておく。
+読む側は np.memmap で開くだけなので、全件をコピーせずにベクトル演算で集計できる。
+
+スナップショットのディレクトリ構成:
+    meta.json          行数・ウォーターマーク (取り込み済みの最大 purchase_id) など
+    <列名>.bin         各列の値 (COLUMNS の dtype の生バイト列、purchase_id 順)
+    user_order.bin     user_id 順に並べた行番号 (ユーザー別インデックス)
+    user_index.bin     (user_id, user_order 内の開始位置, 件数) の表
+
+差分更新:
+    purchase_id がウォーターマークより大きい行だけを末尾に追加する。
+    既存の行の修正・削除は反映されないので、その場合は --full で作り直す。
+    ユーザー別インデックスも並べ直さず、追加分だけを既存のインデックスに差し込む。
+    purchase_date が日付として読めない行は、どの日にも入れられないので書き出さない。
+
+    python -m db.snapshot export [db_path] [--full]
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+# 列名 -> (SELECT する式, dtype)
+COLUMNS = {
+    'purchase_id': ('purchase_id', np.int64),
+    'user_id': ('COALESCE(user_id, 0)', np.int64),
+    # 1970-01-01 からの日数
+    'day': ("CAST(julianday(purchase_date) - 2440587.5 AS INTEGER)", np.int32),
+    'time_period': ("CASE time_period WHEN '朝' THEN 0 WHEN '昼' THEN 1 WHEN '晩' THEN 2 ELSE -1 END", np.int8),
+    'drink_amount': ('COALESCE(drink_amount, 0)', np.int64),
+    'snack_amount': ('COALESCE(snack_amount, 0)', np.int64),
+    'main_dish_amount': ('COALESCE(main_dish_amount, 0)', np.int64),
+    'irregular_amount': ('COALESCE(irregular_amount, 0)', np.int64),
+}
+
+# time_period のコード -> 表示名
+TIME_PERIODS = ('朝', '昼', '晩')
+
+AMOUNT_COLUMNS = ('drink_amount', 'snack_amount', 'main_dish_amount', 'irregular_amount')
+
+_INDEX_DTYPE = np.dtype([('user_id', np.int64), ('start', np.int64), ('count', np.int64)])
+
+# 1回に SQLite から読む行数
+FETCH_SIZE = 10000
+
+_META = 'meta.json'
+
+
+def snapshot_dir_for(db_path):
+    """'oshikatsu.db' -> 'oshikatsu.snapshot' (シャードごとに別ディレクトリ)"""
+    root, _ = os.path.splitext(db_path)
+    return f"{root}.snapshot"
+
+
+def _read_meta(snapshot_dir):
+    path = os.path.join(snapshot_dir, _META)
+    if not os.path.exists(path):
+        return {'rows': 0, 'watermark': 0}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_meta(snapshot_dir, meta):
+    # 途中で落ちても古い meta.json が残るよう、一時ファイルから置き換える
+    path = os.path.join(snapshot_dir, _META)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp, path)
+
+
+def _column_path(snapshot_dir, name):
+    return os.path.join(snapshot_dir, f"{name}.bin")
+
+
+def export_snapshot(conn, snapshot_dir, full=False):
+    """
+    purchases をスナップショットに書き出し、追加した行数を返す
+    full=False ならウォーターマークより新しい行だけを末尾に追加する
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    meta = {'rows': 0, 'watermark': 0} if full else _read_meta(snapshot_dir)
+
+    # meta.json の行数より後ろは前回の書き込み途中で落ちた残りなので切り捨てる
+    for name, (_, dtype) in COLUMNS.items():
+        path = _column_path(snapshot_dir, name)
+        with open(path, 'ab') as f:
+            f.truncate(meta['rows'] * np.dtype(dtype).itemsize)
+
+    select = ", ".join(expr for expr, _ in COLUMNS.values())
+    cursor = conn.execute(f"""
+        SELECT {select} FROM purchases
+        WHERE purchase_id > ? AND julianday(purchase_date) IS NOT NULL
+        ORDER BY purchase_id
+    """, (meta['watermark'],))
+    files = {name: open(_column_path(snapshot_dir, name), 'ab') for name in COLUMNS}
+    added = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            block = np.array(rows, dtype=np.int64)
+            for i, (name, (_, dtype)) in enumerate(COLUMNS.items()):
+                files[name].write(block[:, i].astype(dtype).tobytes())
+            added += len(rows)
+            meta['watermark'] = int(block[-1, 0])
+    finally:
+        for f in files.values():
+            f.close()
+
+    old_rows = meta['rows']
+    meta['rows'] += added
+    if full or not _index_matches(snapshot_dir, old_rows):
+        _build_user_index(snapshot_dir, meta['rows'])
+    elif added:
+        _merge_user_index(snapshot_dir, old_rows, meta['rows'])
+    _write_meta(snapshot_dir, meta)
+    return added
+
+
+def _read_user_index(snapshot_dir):
+    return np.fromfile(os.path.join(snapshot_dir, 'user_index.bin'), dtype=_INDEX_DTYPE)
+
+
+def _index_matches(snapshot_dir, rows):
+    """ユーザー別インデックスが rows 行分のものか (前回の書き出し途中で落ちていないか)"""
+    order_path = os.path.join(snapshot_dir, 'user_order.bin')
+    index_path = os.path.join(snapshot_dir, 'user_index.bin')
+    if not (os.path.exists(order_path) and os.path.exists(index_path)):
+        return False
+    return (os.path.getsize(order_path) == rows * 8
+            and int(_read_user_index(snapshot_dir)['count'].sum()) == rows)
+
+
+def _write_user_index(snapshot_dir, order, uniq, counts):
+    index = np.empty(len(uniq), dtype=_INDEX_DTYPE)
+    index['user_id'] = uniq
+    index['count'] = counts
+    index['start'] = np.cumsum(counts) - counts
+    # 読み込み中の memmap を壊さないよう、一時ファイルに書いてから置き換える
+    for name, array in (('user_order.bin', order.astype(np.int64)), ('user_index.bin', index)):
+        path = os.path.join(snapshot_dir, name)
+        array.tofile(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+
+def _build_user_index(snapshot_dir, rows):
+    """user_id 列からユーザー別インデックス (user_order.bin / user_index.bin) を作り直す"""
+    user_ids = np.memmap(_column_path(snapshot_dir, 'user_id'), dtype=np.int64, mode='r', shape=(rows,)) \
+        if rows else np.empty(0, dtype=np.int64)
+    # 同じユーザー内では purchase_id 順が保たれるよう安定ソート
+    order = np.argsort(user_ids, kind='stable')
+    uniq, counts = np.unique(user_ids[order], return_counts=True)
+    _write_user_index(snapshot_dir, order, uniq, counts)
+
+
+def _merge_user_index(snapshot_dir, old_rows, rows):
+    """
+    old_rows 行目以降の追加分だけを並べ替え、既存のインデックスの各ユーザーの末尾に差し込む
+    追加分は purchase_id が大きいので、ユーザー内の purchase_id 順はそのまま保たれる
+    """
+    old_order = np.fromfile(os.path.join(snapshot_dir, 'user_order.bin'), dtype=np.int64)
+    old_index = _read_user_index(snapshot_dir)
+    new_ids = np.memmap(_column_path(snapshot_dir, 'user_id'), dtype=np.int64, mode='r',
+                        offset=old_rows * 8, shape=(rows - old_rows,))
+    new_sorted = np.argsort(new_ids, kind='stable')
+    new_sorted_ids = np.asarray(new_ids[new_sorted])
+
+    # 差し込む位置 = 同じユーザー (いなければ直前のユーザー) の区間の末尾
+    ends = old_index['start'] + old_index['count']
+    pos = np.searchsorted(old_index['user_id'], new_sorted_ids, side='right')
+    insert_at = np.where(pos > 0, ends[np.maximum(pos - 1, 0)], 0)
+    order = np.insert(old_order, insert_at, new_sorted + old_rows)
+
+    new_uniq, new_counts = np.unique(new_sorted_ids, return_counts=True)
+    uniq, inverse = np.unique(np.concatenate([old_index['user_id'], new_uniq]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([old_index['count'], new_counts]), minlength=len(uniq))
+    _write_user_index(snapshot_dir, order, uniq, counts.astype(np.int64))
+
+
+class Snapshot:
+    """memmap で開いたスナップショット (読み込み専用)"""
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        meta = _read_meta(snapshot_dir)
+        self.rows = meta['rows']
+        self.watermark = meta['watermark']
+        self.columns = {name: self._map(f"{name}.bin", dtype, self.rows) for name, (_, dtype) in COLUMNS.items()}
+        self._order = self._map('user_order.bin', np.int64, self.rows)
+        index_path = os.path.join(snapshot_dir, 'user_index.bin')
+        n_users = os.path.getsize(index_path) // _INDEX_DTYPE.itemsize if os.path.exists(index_path) else 0
+        self._index = self._map('user_index.bin', _INDEX_DTYPE, n_users)
+
+    def _map(self, filename, dtype, length):
+        if length == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.snapshot_dir, filename), dtype=dtype, mode='r', shape=(length,))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __len__(self):
+        return self.rows
+
+    def user_rows(self, user_id):
+        """あるユーザーの行番号 (purchase_id 順) を返す"""
+        pos = np.searchsorted(self._index['user_id'], user_id)
+        if pos >= len(self._index) or self._index['user_id'][pos] != user_id:
+            return np.empty(0, dtype=np.int64)
+        start, count = self._index['start'][pos], self._index['count'][pos]
+        return self._order[start:start + count]
+
+    def totals(self, rows=None):
+        """行ごとの合計金額 (4カテゴリの和) を返す。rows で行番号を絞り込める"""
+        cols = [self.columns[name] if rows is None else self.columns[name][rows] for name in AMOUNT_COLUMNS]
+        return cols[0] + cols[1] + cols[2] + cols[3]
+
+
+def day_number(date_str):
+    """'YYYY-MM-DD' -> 1970-01-01 からの日数 (スナップショットの day 列と同じ)"""
+    return int(np.datetime64(date_str, 'D').astype(np.int64))
+
+
+def monthly_totals_by_user(snapshot, year, month):
+    """
+    (year, month) のユーザー別合計金額を返す
+    戻り値: (user_ids, totals) の NumPy 配列
+    """
+    first = np.datetime64(f"{year:04d}-{month:02d}", 'M')
+    start = first.astype('datetime64[D]').astype(np.int64)
+    end = (first + 1).astype('datetime64[D]').astype(np.int64)
+    day = snapshot['day']
+    # 金額の列は全行を足し合わせず、その月の行だけを memmap から読んで足す
+    rows = np.flatnonzero((day >= start) & (day < end))
+    user_ids, inverse = np.unique(snapshot['user_id'][rows], return_inverse=True)
+    totals = np.bincount(inverse, weights=snapshot.totals(rows), minlength=len(user_ids))
+    return user_ids, totals.astype(np.int64)
+
+
+def main():
+    from . import DB_PATH
+    from .shard import data_db_paths
+    from .storage import connect
+
+    parser = argparse.ArgumentParser(description="purchases の列指向スナップショットの書き出し")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('export', help="前回のウォーターマーク以降の購入を書き出す")
+    p.add_argument('db_path', nargs='?', default=DB_PATH,
+                   help="対象のDB (シャーディング時は全シャードを処理する)")
+    p.add_argument('--full', action='store_true', help="差分ではなく全件を書き出し直す")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        for path in data_db_paths(args.db_path):
+            conn = connect(path, read_only=True)
+            try:
+                added = export_snapshot(conn, snapshot_dir_for(path), full=args.full)
+            finally:
+                conn.close()
+            print(f"Exported {added} rows: {snapshot_dir_for(path)}")
+
+
+if __name__ == '__main__':
+    main()
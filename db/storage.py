@@ -0,0 +1,87 @@
+"""
+SQLite の保存設定 (ストレージプロファイル)
+
+接続ごとにばらばらだった PRAGMA を名前付きのプロファイルにまとめ、
+全ての接続に同じ設定を当てる。使うプロファイルは環境変数 OSHI_STORAGE_PROFILE で選ぶ。
+
+- durable: WAL + synchronous=FULL。コミット済みのデータは電源断でも失われない (既定)
+- fast:    WAL + synchronous=NORMAL + 大きめのキャッシュと mmap。
+           電源断時に直前のコミットが失われうるが、DBが壊れることはない
+- compat:  SQLite の既定値 (ロールバックジャーナル + synchronous=FULL)。比較用
+
+各プロファイルの比較:
+    python bench/storage.py
+"""
+import os
+import sqlite3
+
+PROFILES = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -8000,            # 約8MB (負の値はKB単位)
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 5000,           # ミリ秒
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,           # 約64MB
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+    'compat': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': -2000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 5000,
+    },
+}
+
+DEFAULT_PROFILE = 'durable'
+STORAGE_PROFILE = os.environ.get('OSHI_STORAGE_PROFILE', DEFAULT_PROFILE)
+
+
+def get_profile(name=None):
+    """プロファイル名から設定を返す (未知の名前なら ValueError)"""
+    name = name or STORAGE_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown storage profile: {name} (choose from {', '.join(PROFILES)})")
+    return PROFILES[name]
+
+
+def apply_profile(conn, profile=None, read_only=False):
+    """
+    接続にプロファイルの PRAGMA を設定する
+    journal_mode はファイルに記録される設定なので、読み込み専用の接続では変更しない
+    """
+    settings = get_profile(profile)
+    conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])}")
+    if not read_only:
+        conn.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+    conn.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+    conn.execute(f"PRAGMA cache_size = {int(settings['cache_size'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+    conn.execute(f"PRAGMA temp_store = {settings['temp_store']}")
+    return conn
+
+
+def connect(path, profile=None, read_only=False):
+    """プロファイルを当てた接続を返す (Rowファクトリも設定する)"""
+    if read_only:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    else:
+        conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return apply_profile(conn, profile, read_only)
+
+
+def describe_profile(name=None):
+    """起動時の表示用に、プロファイル名と設定を1行にまとめる"""
+    name = name or STORAGE_PROFILE
+    settings = get_profile(name)
+    return f"{name} (" + ", ".join(f"{k}={v}" for k, v in settings.items()) + ")"
@@ -1,6 +1,20 @@
 from . import get_db_connection
-from .badge_setting import get_settings
-import datetime
+from .badge_setting import fetch_settings, DEFAULT_BADGE_PRICE, DEFAULT_ITABAG_TOTAL_PRICE
+from .calendar import rebuild_weekly_summaries, rebuild_monthly_summaries, month_bounds, normalize_date
+from .percentile import metric_values, update_sketches, rerate_badge_sketch
+from .milestone import record_milestones
+from .query import (
+    fetch_daily_summary, fetch_weekly_summaries, fetch_monthly_summaries,
+    DAILY_COLUMNS, WEEKLY_COLUMNS, MONTHLY_COLUMNS,
+)
+
+# --- 換算レートの取得 ---
+def _get_rates(conn, user_id):
+    """バッジ単価と痛バ総額を返す (集計と同じ接続で読む。未設定なら既定値)"""
+    settings = fetch_settings(conn, user_id)
+    if settings:
+        return settings['badge_price'], settings['itabag_total_price']
+    return DEFAULT_BADGE_PRICE, DEFAULT_ITABAG_TOTAL_PRICE
 
 # --- 共通ヘルパー関数 ---
 def _calculate_amounts_and_upsert(conn, user_id, time_filter_sql, filter_params, target_table, conflict_target, extra_cols_dict):
@@ -32,9 +46,7 @@ def _calculate_amounts_and_upsert(conn, user_id, time_filter_sql, filter_params,
     total_amount = drink + snack + main + irregular
 
     # 2. 設定を取得して換算
-    settings = get_settings(user_id) 
-    badge_price = settings['badge_price']
-    itabag_total_price = settings['itabag_total_price']
+    badge_price, itabag_total_price = _get_rates(conn, user_id)
 
     badge_eq = total_amount / badge_price if badge_price else 0
     itabag_eq = total_amount / itabag_total_price if itabag_total_price else 0
@@ -68,120 +80,153 @@ def _calculate_amounts_and_upsert(conn, user_id, time_filter_sql, filter_params,
     
     conn.execute(upsert_sql, vals)
 
-# --- ヘルパー: 日付計算 ---
-def _get_sunday_to_saturday_range(date_obj):
-    """
-    指定された日付が含まれる週の、日曜日(開始)と土曜日(終了)を返す
-    Pythonのweekday(): 月=0 ... 日=6
-    欲しい仕様: 日=0 ... 土=6 として計算する
-    """
-    # Pythonのweekday() (月0-日6) を、(日0-土6) に変換する
-    # (weekday + 1) % 7 で、日曜日が0、土曜日が6になる
-    day_idx = (date_obj.weekday() + 1) % 7
-    
-    # 開始日（日曜日） = 指定日 - day_idx
-    start_date = date_obj - datetime.timedelta(days=day_idx)
-    # 終了日（土曜日） = 開始日 + 6日
-    end_date = start_date + datetime.timedelta(days=6)
-    
-    return start_date, end_date
-
 # --- 日次集計 ---
+def _upsert_daily(conn, user_id, date_str):
+    _calculate_amounts_and_upsert(
+        conn, user_id,
+        time_filter_sql="AND purchase_date = ?",
+        filter_params=(date_str,),
+        target_table="daily_summaries",
+        conflict_target="user_id, summary_date",
+        extra_cols_dict={'summary_date': date_str}
+    )
+
 def update_daily_summary(user_id, date_str):
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     try:
-        _calculate_amounts_and_upsert(
-            conn, user_id,
-            time_filter_sql="AND purchase_date = ?",
-            filter_params=(date_str,),
-            target_table="daily_summaries",
-            conflict_target="user_id, summary_date",
-            extra_cols_dict={'summary_date': date_str}
-        )
+        _upsert_daily(conn, user_id, date_str)
         conn.commit()
     finally:
         conn.close()
 
-def get_daily_summary(user_id, date_str):
-    conn = get_db_connection()
-    row = conn.execute(
-        "SELECT * FROM daily_summaries WHERE user_id = ? AND summary_date = ?",
-        (user_id, date_str)
-    ).fetchone()
-    conn.close()
-    return row
+def get_daily_summary(user_id, date_str, columns=DAILY_COLUMNS):
+    """1日分の日次集計を取得 (columns で読む列を指定できる)"""
+    conn = get_db_connection(user_id)
+    try:
+        return fetch_daily_summary(conn, user_id, date_str, columns)
+    finally:
+        conn.close()
+
+# --- 週次集計 ---
+# 週の区切り(日〜土)はカレンダー表から引くので、ここでは日付計算をしない
+def _upsert_weekly(conn, user_id, date_str):
+    rebuild_weekly_summaries(conn, user_id, date_str, date_str, *_get_rates(conn, user_id))
 
-# --- 週次集計 (修正箇所) ---
 def update_weekly_summary(user_id, date_obj):
     """指定された日付が含まれる週(日〜土)の集計を更新"""
-    
-    start_date, end_date = _get_sunday_to_saturday_range(date_obj)
-    start_str = start_date.strftime('%Y-%m-%d')
-    end_str = end_date.strftime('%Y-%m-%d')
-
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     try:
-        # 期間指定で集計 (purchase_date BETWEEN start AND end)
-        _calculate_amounts_and_upsert(
-            conn, user_id,
-            time_filter_sql="AND purchase_date >= ? AND purchase_date <= ?",
-            filter_params=(start_str, end_str),
-            target_table="weekly_summaries",
-            conflict_target="user_id, start_date",
-            extra_cols_dict={'start_date': start_str, 'end_date': end_str}
-        )
+        _upsert_weekly(conn, user_id, date_obj.strftime('%Y-%m-%d'))
         conn.commit()
     finally:
         conn.close()
 
-def get_weekly_summaries(user_id):
-    """全週のデータを取得 (開始日順)"""
-    conn = get_db_connection()
-    rows = conn.execute(
-        "SELECT * FROM weekly_summaries WHERE user_id = ? ORDER BY start_date",
-        (user_id,)
-    ).fetchall()
-    conn.close()
-    return rows
+def get_weekly_summaries(user_id, start_date=None, end_date=None, columns=WEEKLY_COLUMNS):
+    """週のデータを開始日順に取得 (start_date / end_date で開始日の範囲を絞れる。省略時は全週)"""
+    conn = get_db_connection(user_id)
+    try:
+        return fetch_weekly_summaries(conn, user_id, start_date, end_date, columns)
+    finally:
+        conn.close()
 
 # --- 月次集計 ---
+def _monthly_rows(conn, user_id, first_day, last_day):
+    """first_day〜last_day の月次集計行を {(year, month): row} で返す"""
+    rows = conn.execute("""
+        SELECT * FROM monthly_summaries
+        WHERE user_id = ? AND year * 100 + month BETWEEN ? AND ?
+    """, (user_id, int(first_day[:4] + first_day[5:7]), int(last_day[:4] + last_day[5:7]))).fetchall()
+    return {(row['year'], row['month']): row for row in rows}
+
+def _rebuild_monthly(conn, user_id, start_date, end_date, badge_price, itabag_total_price):
+    """月次集計を作り直し、変わった値をパーセンタイル用スケッチとバッジの節目イベントにも反映する"""
+    first_day, last_day = month_bounds(conn, start_date, end_date)
+    old_rows = _monthly_rows(conn, user_id, first_day, last_day)
+    rebuild_monthly_summaries(conn, user_id, start_date, end_date, badge_price, itabag_total_price)
+    new_rows = _monthly_rows(conn, user_id, first_day, last_day)
+
+    for year, month in old_rows.keys() | new_rows.keys():
+        old_values = metric_values(old_rows.get((year, month)), badge_price)
+        new_values = metric_values(new_rows.get((year, month)), badge_price)
+        update_sketches(conn, year, month, old_values, new_values)
+        record_milestones(
+            conn, user_id, year, month,
+            old_values['badges'] if old_values else 0,
+            new_values['badges'] if new_values else 0
+        )
+
+def _upsert_monthly(conn, user_id, date_str):
+    _rebuild_monthly(conn, user_id, date_str, date_str, *_get_rates(conn, user_id))
+
 def update_monthly_summary(user_id, date_obj):
     """指定された日付が含まれる月の集計を更新"""
-    year = date_obj.year
-    month = date_obj.month
-    
-    month_str = f"{month:02d}"
-    year_str = str(year)
-
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     try:
-        _calculate_amounts_and_upsert(
-            conn, user_id,
-            time_filter_sql="AND strftime('%Y', purchase_date) = ? AND strftime('%m', purchase_date) = ?",
-            filter_params=(year_str, month_str),
-            target_table="monthly_summaries",
-            conflict_target="user_id, year, month",
-            extra_cols_dict={'year': year, 'month': month}
-        )
+        _upsert_monthly(conn, user_id, date_obj.strftime('%Y-%m-%d'))
         conn.commit()
     finally:
         conn.close()
 
-def get_monthly_summaries(user_id):
-    """全月のデータを取得"""
-    conn = get_db_connection()
-    rows = conn.execute(
-        "SELECT * FROM monthly_summaries WHERE user_id = ? ORDER BY year, month",
-        (user_id,)
-    ).fetchall()
-    conn.close()
-    return rows
+def get_monthly_summaries(user_id, start=None, end=None, columns=MONTHLY_COLUMNS):
+    """月のデータを年月順に取得 (start / end は (year, month)。省略時は全月)"""
+    conn = get_db_connection(user_id)
+    try:
+        return fetch_monthly_summaries(conn, user_id, start, end, columns)
+    finally:
+        conn.close()
+
+# --- まとめて更新 ---
+def refresh_summaries(conn, user_id, date_str):
+    """
+    購入の追加後に、その日付を含む日次・週次・月次の集計を更新する
+    渡された接続のトランザクション内で実行し、コミットは呼び出し側で行う
+    date_str: 'YYYY-MM-DD' 形式 (ゼロ埋めしていない日付はそろえてから使う。不正な場合は ValueError)
+    """
+    # 日付形式のチェックとゼロ埋め (不正なら ValueError)
+    date_str = normalize_date(date_str)
+    _upsert_daily(conn, user_id, date_str)
+    _upsert_weekly(conn, user_id, date_str)
+    _upsert_monthly(conn, user_id, date_str)
+
+def rebuild_summaries(conn, user_id, start_date, end_date):
+    """
+    start_date〜end_date にかかる週次・月次集計を、期間ごとのループではなく
+    カレンダー表との JOIN + GROUP BY でまとめて作り直す (コミットは呼び出し側)
+    """
+    rates = _get_rates(conn, user_id)
+    rebuild_weekly_summaries(conn, user_id, start_date, end_date, *rates)
+    _rebuild_monthly(conn, user_id, start_date, end_date, *rates)
+
+# --- 換算値の付け直し ---
+# 集計テーブル -> 合計金額の列
+_SUMMARY_TOTAL_COLUMNS = (
+    ('daily_summaries', 'daily_total'),
+    ('weekly_summaries', 'weekly_total'),
+    ('monthly_summaries', 'monthly_total'),
+)
+
+def rerate_summaries(conn, user_id, badge_price, itabag_total_price, old_badge_price=None):
+    """
+    設定の変更後に、ユーザーの全集計行の缶バッジ換算・痛バ換算を新しいレートで付け直す
+    期間ごとに集計をやり直さず、テーブルごとに1本の UPDATE で済ませる (コミットは呼び出し側)
+    old_badge_price を渡すと、パーセンタイル用のバッジ数スケッチも付け替える
+    """
+    for table, total_col in _SUMMARY_TOTAL_COLUMNS:
+        conn.execute(f"""
+            UPDATE {table}
+            SET badge_equivalent = COALESCE({total_col} * 1.0 / NULLIF(?, 0), 0),
+                itabag_equivalent = COALESCE({total_col} * 1.0 / NULLIF(?, 0), 0)
+            WHERE user_id = ?
+        """, (badge_price, itabag_total_price, user_id))
+
+    if old_badge_price is not None and old_badge_price != badge_price:
+        rerate_badge_sketch(conn, user_id, old_badge_price, badge_price)
 
 def get_daily_details_by_time_period(user_id, date_str):
     """
     指定した日付の購入データを時間帯(time_period)ごとに集計して返す。
     """
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     try:
         # 修正ポイント:
         # 1. 'amount' カラムはないので、各カテゴリの金額を合計して集計します。
@@ -225,7 +270,7 @@ def get_period_details_by_date_range(user_id, start_date_str, end_date_str):
     """
     指定した期間（開始日〜終了日）の購入データを時間帯(time_period)ごとに集計して返す。
     """
-    conn = get_db_connection()
+    conn = get_db_connection(user_id)
     try:
         # 期間指定(>= start AND <= end)で集計
         query = """
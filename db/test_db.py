@@ -7,7 +7,13 @@ from db import user as User
 from db import badge_setting as Setting
 from db import purchase as Purchase
 from db import summary as Summary
+from db import ensure_schema
+from db.storage import connect
 import datetime
+import os
+import shutil
+import tempfile
+import time
 
 def test_db_operations():
     # 1. DB初期化 (初回のみ実行される)
@@ -70,5 +76,544 @@ def test_db_operations():
     else:
         print("集計データがありません")
 
+# --- 以下は一時ファイルのDBで動作を確認する (app.db には触らない) ---
+
+def _temp_db(usernames=("otaku_user",)):
+    """スキーマを作った一時DBを作り、(ディレクトリ, パス, 接続) を返す"""
+    work = tempfile.mkdtemp()
+    path = os.path.join(work, "test.db")
+    conn = connect(path)
+    ensure_schema(conn)
+    for name in usernames:
+        conn.execute("INSERT INTO users (username, password_hash) VALUES (?, 'x')", (name,))
+    conn.commit()
+    return work, path, conn
+
+def test_reshard():
+    print("\n--- シャード分割 ---")
+    from db import SCHEMA_PATH, SCHEMA_VERSION
+    from db.shard import reshard, data_db_paths
+    from db.consistency import check_all
+    from db.search import search_purchases
+
+    work, path, conn = _temp_db(tuple(f"user{i}" for i in range(1, 7)))
+    try:
+        for user_id in range(1, 7):
+            for day in range(1, user_id + 2):
+                Purchase.record_purchase(conn, user_id, f'2025-07-{day:02d}', '昼', {'main': 400 * user_id}, memo=f"推し活カフェ {user_id}")
+        purchases = conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0]
+        buckets = dict(conn.execute("SELECT metric, SUM(count) FROM percentile_buckets GROUP BY metric").fetchall())
+        conn.close()
+
+        reshard(path, 3, SCHEMA_PATH)
+        shards = data_db_paths(path, 3)
+
+        # ディレクトリDBには users だけが残る
+        conn = connect(path)
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 6
+        assert conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM percentile_buckets").fetchone()[0] == 0
+
+        counts = []
+        sharded_buckets = {}
+        for i, shard in enumerate(shards):
+            shard_conn = connect(shard)
+            try:
+                # 作ったシャードは最新のスキーマとして記録され、起動時に作り直されない
+                assert shard_conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+                assert not ensure_schema(shard_conn)
+                owners = {row[0] for row in shard_conn.execute("SELECT DISTINCT user_id FROM purchases")}
+                assert owners == {u for u in range(1, 7) if u % 3 == i}
+                counts.append(shard_conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0])
+                for metric, total in shard_conn.execute("SELECT metric, SUM(count) FROM percentile_buckets GROUP BY metric"):
+                    sharded_buckets[metric] = sharded_buckets.get(metric, 0) + total
+                # メモの検索索引もシャード側で引ける
+                user_id = min(owners)
+                rows, _ = search_purchases(shard_conn, user_id, "推し活カフェ")
+                assert len(rows) == user_id + 1
+            finally:
+                shard_conn.close()
+
+        assert sum(counts) == purchases
+        assert sharded_buckets == buckets
+        assert check_all(shards, full=True)['repaired'] == 0
+        print(f"purchases per shard: {counts}")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_writer_group_commit():
+    print("\n--- 書き込みスレッドのまとめてコミット ---")
+    from db.writer import PurchaseWriter
+
+    work, path, conn = _temp_db()
+    try:
+        # まとめてコミットし、失敗した1件 (時間帯が不正) だけが巻き戻される
+        writer = PurchaseWriter(path)
+        futures = [writer.submit(1, '2025-12-02', '晩', {'irregular': 100}) for _ in range(10)]
+        bad = writer.submit(1, '2025-12-02', '夜', {'irregular': 999})
+        ids = [f.result(timeout=10) for f in futures]
+        try:
+            bad.result(timeout=10)
+            raise AssertionError("invalid time_period was accepted")
+        except Exception as e:
+            print(f"rejected: {e}")
+        writer.stop(timeout=10)
+
+        assert len(set(ids)) == 10
+        total = conn.execute(
+            "SELECT daily_total FROM daily_summaries WHERE user_id = 1 AND summary_date = '2025-12-02'"
+        ).fetchone()[0]
+        monthly = conn.execute(
+            "SELECT monthly_total FROM monthly_summaries WHERE user_id = 1 AND year = 2025 AND month = 12"
+        ).fetchone()[0]
+        assert total == monthly == 1000
+        assert conn.execute("SELECT COUNT(*) FROM purchases WHERE time_period = '夜'").fetchone()[0] == 0
+
+        # 書き込みが始まる前に取り消した操作は保存されない
+        writer = PurchaseWriter(path)
+        conn.execute("BEGIN IMMEDIATE")  # ロックを持ったままにして、書き込みスレッドを待たせる
+        first = writer.submit(1, '2025-12-03', '朝', {'drink': 100})
+        while not first.running():
+            time.sleep(0.01)
+        # first がロック待ちの間に依頼した操作は、まだ取り出されていないので取り消せる
+        cancelled = writer.submit(1, '2025-12-03', '朝', {'drink': 5000})
+        assert cancelled.cancel()
+        conn.rollback()
+        first.result(timeout=10)
+        writer.stop(timeout=10)
+        drinks = [row[0] for row in conn.execute("SELECT drink_amount FROM purchases WHERE purchase_date = '2025-12-03'")]
+        assert drinks == [100]
+        print(f"daily: {total}円, ids: {len(ids)}")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_calendar_rebuild():
+    print("\n--- カレンダー表での週次・月次集計の作り直し ---")
+    work, path, conn = _temp_db()
+    try:
+        # 2025-05-25(日)〜05-31(土) と 06-01(日)〜06-07(土) の2週、5月と6月の2か月にまたがる
+        for date_str, amount in (('2025-05-30', 100), ('2025-05-31', 200), ('2025-06-01', 300), ('2025-6-2', 400)):
+            Purchase.record_purchase(conn, 1, date_str, '昼', {'main': amount})
+        # ゼロ埋めしていない日付も 'YYYY-MM-DD' にそろえて保存・集計される
+        assert conn.execute("SELECT COUNT(*) FROM purchases WHERE purchase_date = '2025-06-02'").fetchone()[0] == 1
+
+        weekly = [tuple(r) for r in conn.execute("SELECT start_date, end_date, weekly_total FROM weekly_summaries ORDER BY start_date")]
+        monthly = [tuple(r) for r in conn.execute("SELECT year, month, monthly_total FROM monthly_summaries ORDER BY year, month")]
+        assert weekly == [('2025-05-25', '2025-05-31', 300), ('2025-06-01', '2025-06-07', 700)]
+        assert monthly == [(2025, 5, 300), (2025, 6, 700)]
+
+        # 6月の購入を消して作り直すと、購入の無くなった週・月の行は削除される
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM purchases WHERE purchase_date >= '2025-06-01'")
+        Summary.rebuild_summaries(conn, 1, '2025-05-01', '2025-06-30')
+        conn.commit()
+        weekly = [tuple(r) for r in conn.execute("SELECT start_date, weekly_total FROM weekly_summaries ORDER BY start_date")]
+        monthly = [tuple(r) for r in conn.execute("SELECT year, month, monthly_total FROM monthly_summaries ORDER BY year, month")]
+        assert weekly == [('2025-05-25', 300)]
+        assert monthly == [(2025, 5, 300)]
+
+        # 不正な日付は保存しない
+        try:
+            Purchase.record_purchase(conn, 1, '2025-02-30', '昼', {'main': 100})
+            raise AssertionError("invalid date was accepted")
+        except ValueError as e:
+            print(f"rejected: {e}")
+        assert conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0] == 2
+        print(f"weekly: {weekly}, monthly: {monthly}")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_consistency_repairs_drift():
+    print("\n--- 集計のずれの検出と修復 ---")
+    from db.consistency import check_all, check_user
+
+    work, path, conn = _temp_db()
+    try:
+        for day in range(1, 11):
+            Purchase.record_purchase(conn, 1, f'2025-11-{day:02d}', '昼', {'main': 500})
+        assert check_all([path], full=True)['repaired'] == 0
+        # ダイジェストが変わっていなければ何も検証しない
+        assert check_user(path, 1) == (0, 0)
+
+        # 購入を集計を通さずに追加する (集計更新の前に落ちた場合と同じ)
+        conn.execute("INSERT INTO purchases (user_id, purchase_date, time_period, drink_amount) VALUES (1, '2025-11-05', '朝', 300)")
+        conn.commit()
+        report = check_all([path], sample=0)
+        assert report['repaired'] > 0
+
+        # 集計テーブルだけが壊れた場合は全期間の検証で見つかる
+        conn.execute("UPDATE daily_summaries SET daily_total = 0")
+        conn.commit()
+        assert check_all([path], full=True)['repaired'] > 0
+
+        expected = conn.execute("SELECT SUM(drink_amount + main_dish_amount) FROM purchases").fetchone()[0]
+        monthly = conn.execute("SELECT monthly_total FROM monthly_summaries WHERE year = 2025 AND month = 11").fetchone()[0]
+        daily = conn.execute("SELECT daily_total FROM daily_summaries WHERE summary_date = '2025-11-05'").fetchone()[0]
+        assert monthly == expected == 5300 and daily == 800
+
+        # 購入の無い日・週・月の集計行は削除される (0円の行として残さない)
+        conn.execute("INSERT INTO daily_summaries (user_id, summary_date, daily_total, main_dish_total) VALUES (1, '2025-11-20', 500, 500)")
+        conn.execute("INSERT INTO weekly_summaries (user_id, start_date, end_date, weekly_total) VALUES (1, '2025-11-23', '2025-11-29', 500)")
+        conn.execute("INSERT INTO monthly_summaries (user_id, year, month, monthly_total) VALUES (1, 2025, 12, 500)")
+        conn.commit()
+        assert check_all([path], full=True)['repaired'] == 3
+        assert conn.execute("SELECT COUNT(*) FROM daily_summaries WHERE summary_date = '2025-11-20'").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM weekly_summaries WHERE start_date = '2025-11-23'").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM monthly_summaries WHERE month = 12").fetchone()[0] == 0
+
+        assert check_all([path], full=True)['repaired'] == 0
+        print(f"repaired, monthly: {monthly}円")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_admission_gate():
+    print("\n--- 受付制御 (待ち行列と待ち時間の上限) ---")
+    import threading
+    from flask import Flask
+    from admission import AdmissionGate, admission_required
+
+    gate = AdmissionGate('test', max_concurrent=1, max_queue=1, timeout=0.2)
+    assert gate.acquire()
+
+    # 枠が埋まっていると待ち行列に入り、timeout を過ぎたら断られる
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(gate.acquire()))
+    waiter.start()
+    while gate.snapshot()['waiting'] == 0:
+        time.sleep(0.01)
+    # 待ち行列も埋まっていれば待たずに断られる
+    assert not gate.acquire()
+    waiter.join()
+    assert results == [False]
+
+    # 待っている間に枠が空けば受け付けられる
+    waiter = threading.Thread(target=lambda: results.append(gate.acquire()))
+    waiter.start()
+    while gate.snapshot()['waiting'] == 0:
+        time.sleep(0.01)
+    gate.release(0.05)
+    waiter.join()
+    assert results == [False, True]
+    gate.release(0.05)
+
+    stats = gate.snapshot()
+    assert (stats['admitted'], stats['rejected_queue_full'], stats['rejected_timeout']) == (2, 1, 1)
+    assert stats['in_flight'] == 0 and stats['waiting'] == 0
+
+    # ルートに付けると、あふれた分は 503 + Retry-After になる
+    app = Flask(__name__)
+    busy = AdmissionGate('busy', max_concurrent=1, max_queue=0, timeout=0.2)
+
+    @app.route('/api/ping')
+    @admission_required(busy)
+    def ping():
+        return {'ok': True}
+
+    client = app.test_client()
+    assert client.get('/api/ping').status_code == 200
+    assert busy.acquire()
+    response = client.get('/api/ping')
+    busy.release(0.01)
+    assert response.status_code == 503 and int(response.headers['Retry-After']) >= 1
+    print(f"stats: {stats}")
+
+def test_snapshot_merge_index():
+    print("\n--- スナップショットのユーザー別インデックスの差分更新 ---")
+    from db.snapshot import export_snapshot, Snapshot, monthly_totals_by_user
+
+    work, path, conn = _temp_db(tuple(f"user{i}" for i in range(1, 7)))
+    try:
+        for user_id, day in ((4, 1), (2, 2), (4, 3), (2, 4)):
+            Purchase.record_purchase(conn, user_id, f'2025-06-{day:02d}', '朝', {'drink': 100 * user_id})
+        incremental = os.path.join(work, "incremental")
+        assert export_snapshot(conn, incremental) == 4
+
+        # 先頭 (1)・間 (3)・末尾 (6) の新しいユーザーと、既存のユーザー (4) に追加する
+        for user_id, day in ((3, 5), (1, 6), (4, 7), (6, 8), (1, 9), (3, 10)):
+            Purchase.record_purchase(conn, user_id, f'2025-06-{day:02d}', '昼', {'main': 1000 + user_id})
+        # 日付として読めない行は書き出さない
+        conn.execute("INSERT INTO purchases (user_id, purchase_date, time_period, drink_amount) VALUES (2, 'unknown', '朝', 999)")
+        conn.commit()
+        assert export_snapshot(conn, incremental) == 6
+
+        # 差し込んだインデックスは全件から作り直したものとバイト単位で一致する
+        full = os.path.join(work, "full")
+        export_snapshot(conn, full, full=True)
+        for name in ('user_order.bin', 'user_index.bin'):
+            with open(os.path.join(incremental, name), 'rb') as a, open(os.path.join(full, name), 'rb') as b:
+                assert a.read() == b.read(), name
+
+        snapshot = Snapshot(incremental)
+        for user_id in range(1, 7):
+            expected = [row[0] for row in conn.execute(
+                "SELECT purchase_id FROM purchases WHERE user_id = ? AND purchase_date != 'unknown' ORDER BY purchase_id", (user_id,)
+            )]
+            assert snapshot['purchase_id'][snapshot.user_rows(user_id)].tolist() == expected
+
+        user_ids, totals = monthly_totals_by_user(snapshot, 2025, 6)
+        expected = conn.execute("""
+            SELECT user_id, SUM(drink_amount + snack_amount + main_dish_amount + irregular_amount)
+            FROM purchases WHERE purchase_date LIKE '2025-06-%' GROUP BY user_id ORDER BY user_id
+        """).fetchall()
+        assert list(zip(user_ids.tolist(), totals.tolist())) == [tuple(row) for row in expected]
+        print(f"rows: {len(snapshot)}, users: {user_ids.tolist()}")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_percentile_after_rerate():
+    print("\n--- バッジ単価変更後のパーセンタイル用スケッチ ---")
+    from db.percentile import rebuild_sketches
+    from db.badge_setting import DEFAULT_BADGE_PRICE
+
+    work, path, conn = _temp_db(("a", "b", "c"))
+    try:
+        for user_id, amount in ((1, 1200), (2, 6000), (3, 30000)):
+            Purchase.record_purchase(conn, user_id, '2025-10-10', '晩', {'main': amount})
+
+        # user 2 の単価を 600 -> 250 に変えて、集計とスケッチを付け直す
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT INTO badge_settings (user_id, badge_price, badges_per_bag, itabag_total_price) VALUES (2, 250, 35, 8750)")
+        Summary.rerate_summaries(conn, 2, 250, 8750, DEFAULT_BADGE_PRICE)
+        conn.commit()
+        rerated = sorted(tuple(r) for r in conn.execute("SELECT year, month, metric, bucket, count FROM percentile_buckets WHERE count != 0"))
+
+        # monthly_summaries から作り直したものと一致する
+        rebuild_sketches(conn, DEFAULT_BADGE_PRICE)
+        rebuilt = sorted(tuple(r) for r in conn.execute("SELECT year, month, metric, bucket, count FROM percentile_buckets WHERE count != 0"))
+        assert rerated == rebuilt
+
+        badge_eq = conn.execute("SELECT badge_equivalent FROM monthly_summaries WHERE user_id = 2").fetchone()[0]
+        assert badge_eq == 6000 / 250
+        # 日次・週次の換算値も付け直され、他のユーザーの換算値はそのまま
+        for table in ('daily_summaries', 'weekly_summaries'):
+            values = dict(conn.execute(f"SELECT user_id, badge_equivalent FROM {table}").fetchall())
+            assert values == {1: 1200 / DEFAULT_BADGE_PRICE, 2: 6000 / 250, 3: 30000 / DEFAULT_BADGE_PRICE}, table
+        print(f"buckets: {len(rebuilt)}, badge_equivalent: {badge_eq}")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_heatmap_invalidation():
+    print("\n--- ヒートマップのキャッシュと読み込み中の無効化 ---")
+    from db import heatmap
+    from db.writer import PurchaseWriter
+
+    work, path, conn = _temp_db()
+    heatmap._cache.clear()
+    try:
+        Purchase.record_purchase(conn, 1, '2025-01-02', '朝', {'drink': 100})
+        opened = []
+
+        def open_conn():
+            opened.append(1)
+            return connect(path, read_only=True)
+
+        def open_conn_with_write():
+            # 読み込みの途中で購入が追加された場合と同じ
+            opened.append(1)
+            read_conn = connect(path, read_only=True)
+            heatmap.invalidate_heatmap(1, 2025)
+            return read_conn
+
+        # 読み込み中に無効化された結果は返すがキャッシュしない
+        result = heatmap.get_year_heatmap(open_conn_with_write, 1, 2025)
+        assert result['totals'][1] == 100 and len(opened) == 1
+        assert (1, 2025) not in heatmap._cache and not heatmap._loading
+        heatmap.get_year_heatmap(open_conn, 1, 2025)
+        assert len(opened) == 2
+
+        # 次はキャッシュから返す (接続を開かない)
+        heatmap.get_year_heatmap(open_conn, 1, 2025, breakdowns=('category',))
+        assert len(opened) == 2
+
+        # 読み込み中でないキーの無効化は何も覚えない
+        heatmap.invalidate_heatmap(1, 2024)
+        assert not heatmap._loading
+
+        # 書き込みスレッドがコミット後にキャッシュを捨てるので、次の取得で反映される
+        writer = PurchaseWriter(path)
+        writer.submit(1, '2025-01-02', '晩', {'main': 900}).result(timeout=10)
+        writer.stop(timeout=10)
+        result = heatmap.get_year_heatmap(open_conn, 1, 2025, breakdowns=('time_period',))
+        assert len(opened) == 3
+        assert result['totals'][1] == 1000 and result['time_periods']['晩'][1] == 900
+        assert not heatmap._loading
+        print(f"2025-01-02: {result['totals'][1]}円, loads: {len(opened)}")
+    finally:
+        heatmap._cache.clear()
+        conn.close()
+        shutil.rmtree(work)
+
+def test_record_purchase():
+    print("\n--- 購入の追加と集計 (record_purchase) ---")
+    work, path, conn = _temp_db()
+    try:
+        # 1件ずつの追加で日・月の集計が同じトランザクションで更新される
+        Purchase.record_purchase(conn, 1, '2025-12-01', '朝', {'drink': 150, 'snack': 200})
+        Purchase.record_purchase(conn, 1, '2025-12-01', '昼', {'main': 1200}, memo="推し活カフェ")
+        daily = conn.execute(
+            "SELECT daily_total, drink_total, main_dish_total FROM daily_summaries WHERE user_id = 1 AND summary_date = '2025-12-01'"
+        ).fetchone()
+        assert tuple(daily) == (1550, 150, 1200)
+        assert not conn.in_transaction
+
+        # 失敗したら購入も集計も残らない (時間帯が不正)
+        try:
+            Purchase.record_purchase(conn, 1, '2025-12-01', '夜', {'main': 999})
+            raise AssertionError("invalid time_period was accepted")
+        except Exception as e:
+            print(f"rejected: {e}")
+        assert not conn.in_transaction
+        assert conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0] == 2
+
+        # 呼び出し側のトランザクション内では、失敗した1件だけを巻き戻してコミットは呼び出し側に任せる
+        conn.execute("BEGIN IMMEDIATE")
+        Purchase.record_purchase(conn, 1, '2025-12-01', '晩', {'irregular': 50})
+        try:
+            Purchase.record_purchase(conn, 1, '2025-12-01', '夜', {'main': 999})
+            raise AssertionError("invalid time_period was accepted")
+        except Exception as e:
+            print(f"rejected: {e}")
+        assert conn.in_transaction
+        conn.commit()
+        daily = conn.execute("SELECT daily_total FROM daily_summaries WHERE summary_date = '2025-12-01'").fetchone()[0]
+        monthly = conn.execute("SELECT monthly_total FROM monthly_summaries WHERE year = 2025 AND month = 12").fetchone()[0]
+        assert daily == monthly == 1600
+        print(f"daily: {daily}円")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_search_pagination():
+    print("\n--- メモ検索のページング ---")
+    from db.search import search_purchases
+
+    work, path, conn = _temp_db(("a", "b"))
+    try:
+        for day in range(1, 8):
+            Purchase.record_purchase(conn, 1, f'2025-09-{day:02d}', '昼', {'main': 800}, memo=f"推し活カフェ {day}回目")
+        Purchase.record_purchase(conn, 1, '2025-09-03', '朝', {'drink': 120}, memo="コンビニ")
+        Purchase.record_purchase(conn, 2, '2025-09-03', '昼', {'main': 900}, memo="推し活カフェ 他人")
+
+        pages, cursor = [], None
+        while True:
+            rows, cursor = search_purchases(conn, 1, "推し活カフェ", cursor=cursor, limit=3)
+            pages.append([row['purchase_date'] for row in rows])
+            if cursor is None:
+                break
+        assert [len(p) for p in pages] == [3, 3, 1]
+        assert sum(pages, []) == [f'2025-09-{day:02d}' for day in range(7, 0, -1)]
+
+        rows, _ = search_purchases(conn, 1, "カフェ 3回", start_date='2025-09-02', end_date='2025-09-05')
+        assert [row['memo'] for row in rows] == ["推し活カフェ 3回目"]
+
+        # メモの変更・購入の削除は索引にも反映される
+        conn.execute("UPDATE purchases SET memo = 'お弁当' WHERE user_id = 1 AND purchase_date = '2025-09-07'")
+        conn.execute("DELETE FROM purchases WHERE user_id = 1 AND purchase_date = '2025-09-06'")
+        conn.commit()
+        rows, _ = search_purchases(conn, 1, "推し活カフェ")
+        assert [row['purchase_date'] for row in rows] == [f'2025-09-{day:02d}' for day in range(5, 0, -1)]
+        rows, _ = search_purchases(conn, 1, "お弁当")
+        assert [row['purchase_date'] for row in rows] == ['2025-09-07']
+
+        # メモのある購入が入ったDBを init_db で作り直しても、トリガーで止まらない
+        import db
+        original = db.DB_PATH
+        db.DB_PATH = path
+        try:
+            init_db()
+        finally:
+            db.DB_PATH = original
+        assert conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0] == 0
+        assert search_purchases(conn, 1, "推し活カフェ")[0] == []
+        print(f"pages: {pages}")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
+def test_backup_and_restore():
+    print("\n--- バックアップと復元 ---")
+    from db.backup import backup_database, verify_backup, restore_backup
+
+    work, path, conn = _temp_db()
+    try:
+        for day in range(1, 29):
+            Purchase.record_purchase(conn, 1, f'2025-08-{day:02d}', '朝', {'drink': 100 + day})
+
+        backup_path = os.path.join(work, "backup.db")
+        result = backup_database(path, backup_path, pages_per_step=2)
+        assert result['counts']['purchases'] == 28
+        assert not os.path.exists(backup_path + '.partial')
+
+        restored_path = os.path.join(work, "restored.db")
+        counts = restore_backup(backup_path, restored_path)
+        assert counts == verify_backup(path) == result['counts']
+        restored = connect(restored_path, read_only=True)
+        total = restored.execute("SELECT monthly_total FROM monthly_summaries WHERE year = 2025 AND month = 8").fetchone()[0]
+        restored.close()
+        assert total == sum(100 + day for day in range(1, 29))
+
+        # 壊れたバックアップは復元しない
+        with open(backup_path, 'r+b') as f:
+            f.seek(100)
+            f.write(b'\xff' * 4096)
+        try:
+            restore_backup(backup_path, os.path.join(work, "broken.db"))
+            raise AssertionError("corrupted backup was restored")
+        except Exception as e:
+            print(f"rejected: {e}")
+        assert not os.path.exists(os.path.join(work, "broken.db"))
+
+        # WAL のDBは書き込みを止めずに、開始時点の状態を1ファイルとして取れる
+        import threading
+        conn.execute("PRAGMA journal_mode = WAL")
+        before = conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0]
+        started = threading.Event()
+
+        def keep_writing():
+            writer_conn = connect(path)
+            try:
+                for day in range(1, 29):
+                    Purchase.record_purchase(writer_conn, 1, f'2025-07-{day:02d}', '晩', {'main': 100})
+                    started.set()
+            finally:
+                writer_conn.close()
+
+        thread = threading.Thread(target=keep_writing)
+
+        def on_progress(done, total):
+            # 最初のステップの後に書き込みを始め、それが進むのを待ってから続きをコピーする
+            if not thread.is_alive() and not started.is_set():
+                thread.start()
+                assert started.wait(10)
+
+        wal_path = os.path.join(work, "wal-backup.db")
+        wal_result = backup_database(path, wal_path, pages_per_step=1, step_pause=0.001, progress=on_progress)
+        thread.join()
+        assert wal_result['restarts'] == 0
+        assert wal_result['counts']['purchases'] == before
+        assert conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0] == before + 28
+        assert not os.path.exists(wal_path + '-wal')
+        print(f"backup: {result['pages']} pages, restored monthly_total: {total}円")
+    finally:
+        conn.close()
+        shutil.rmtree(work)
+
 if __name__ == "__main__":
-    test_db_operations()
\ No newline at end of file
+    test_db_operations()
+    test_reshard()
+    test_writer_group_commit()
+    test_calendar_rebuild()
+    test_consistency_repairs_drift()
+    test_admission_gate()
+    test_snapshot_merge_index()
+    test_percentile_after_rerate()
+    test_heatmap_invalidation()
+    test_record_purchase()
+    test_search_pagination()
+    test_backup_and_restore()
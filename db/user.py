@@ -1,4 +1,5 @@
 from . import get_db_connection
+from .query import fetch_user_by_username, fetch_user_by_id, USER_COLUMNS
 import sqlite3
 
 def create_user(username, password_hash):
@@ -19,20 +20,21 @@ def create_user(username, password_hash):
     finally:
         conn.close()
 
-def get_user_by_username(username):
-    """ユーザー名からユーザー情報を取得（ログイン用）"""
+def get_user_by_username(username, columns=USER_COLUMNS):
+    """
+    ユーザー名からユーザー情報を取得
+    ログインの照合に使うときは columns に 'password_hash' を含めて指定する
+    """
     conn = get_db_connection()
-    user = conn.execute(
-        "SELECT * FROM users WHERE username = ?", (username,)
-    ).fetchone()
-    conn.close()
-    return user
+    try:
+        return fetch_user_by_username(conn, username, columns)
+    finally:
+        conn.close()
 
-def get_user_by_id(user_id):
-    """IDからユーザー情報を取得"""
+def get_user_by_id(user_id, columns=USER_COLUMNS):
+    """IDからユーザー情報を取得 (既定では password_hash を含めない)"""
     conn = get_db_connection()
-    user = conn.execute(
-        "SELECT * FROM users WHERE user_id = ?", (user_id,)
-    ).fetchone()
-    conn.close()
-    return user
\ No newline at end of file
+    try:
+        return fetch_user_by_id(conn, user_id, columns)
+    finally:
+        conn.close()
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+購入データの書き込み専用スレッド (グループコミット)
+
+リクエストごとに接続を開いて INSERT → コミット → 集計更新 → コミット、と
+していると、同時アクセス時に fsync が何度も走り、ロック待ちも起きる。
+ここでは DB ファイルごとに1本の書き込みスレッドだけが書き込み接続を持ち、
+キューに溜まった操作をまとめて1トランザクションでコミットしてから
+各呼び出し元に結果を返す。読み込みは従来どおり別の接続で行う。
+
+呼び出し側が待ちきれずに Future.cancel() した操作は、書き込み開始前なら捨てる。
+書き込みを始めた操作は取り消せないので、呼び出し側には「処理中」として扱ってもらう。
+"""
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
+
+from .heatmap import invalidate_heatmap
+from .purchase import record_purchase
+from .storage import connect
+
+# 1回のコミットにまとめる最大件数
+MAX_BATCH_SIZE = 64
+
+# 停止指示用の目印
+_STOP = object()
+
+
+class PurchaseWriter:
+    """1つのDBファイルに対する書き込みスレッド"""
+
+    def __init__(self, db_path, max_batch_size=MAX_BATCH_SIZE):
+        self.db_path = db_path
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """書き込みスレッドを起動する (起動済みなら何もしない)"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f"purchase-writer:{self.db_path}", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """キューに残っている操作を書き終えてからスレッドを止める"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def submit(self, user_id, date_str, time_period, amounts, memo=""):
+        """
+        購入の追加と集計更新を依頼する
+        戻り値の Future はコミット完了後に purchase_id を返す
+        """
+        self.start()
+        future = Future()
+        self._queue.put((future, (user_id, date_str, time_period, amounts, memo)))
+        return future
+
+    def _run(self):
+        conn = connect(self.db_path)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                batch = [item]
+                # 待っている間に溜まった分をまとめて取り出す
+                stop_requested = False
+                while len(batch) < self.max_batch_size:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stop_requested = True
+                        break
+                    batch.append(item)
+                self._commit_batch(conn, batch)
+                if stop_requested:
+                    break
+        finally:
+            conn.close()
+
+    def _commit_batch(self, conn, batch):
+        """まとめた操作を1トランザクションで書き込み、結果を各 Future に返す"""
+        # 取り消し済みの操作は書かない (ここで実行中にした操作は、以降 cancel() できない)
+        batch = [(future, op) for future, op in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for future, (user_id, date_str, time_period, amounts, memo) in batch:
+                # トランザクション内では record_purchase が SAVEPOINT で区切るので、
+                # 1件の失敗でまとめた他の操作まで巻き戻されない
+                try:
+                    purchase_id = record_purchase(conn, user_id, date_str, time_period, amounts, memo)
+                except Exception as e:
+                    results.append((future, None, e, user_id, date_str))
+                else:
+                    results.append((future, purchase_id, None, user_id, date_str))
+            conn.commit()
+        except Exception as e:
+            # コミット自体に失敗した場合はまとめた全件を失敗扱いにする
+            if conn.in_transaction:
+                conn.rollback()
+            for future, _ in batch:
+                future.set_exception(e)
+            return
+
+        for future, purchase_id, error, user_id, date_str in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                # 呼び出し側が待つのをやめていても、コミットした分のキャッシュは必ず捨てる
+                invalidate_heatmap(user_id, int(date_str[:4]))
+                future.set_result(purchase_id)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(db_path):
+    """DBファイルごとに1つの書き込みスレッドを返す (シャードごとに別スレッド)"""
+    with _writers_lock:
+        writer = _writers.get(db_path)
+        if writer is None:
+            writer = PurchaseWriter(db_path)
+            _writers[db_path] = writer
+        return writer
+
+
+@atexit.register
+def stop_all_writers():
+    """プロセス終了時にキューに残った操作を書き切る"""
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        writer.stop(timeout=5)
@@ -1,136 +1,193 @@
 import os
-import sqlite3
 import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
 from flask_wtf import FlaskForm
+from jinja2 import FileSystemBytecodeCache
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, EqualTo, ValidationError
 from werkzeug.security import generate_password_hash, check_password_hash
+from db.purchase import fetch_purchase_page
+from db.shard import resolve_db_path, data_db_paths
+from db.writer import get_writer
+from db import ensure_schema
+from db.percentile import get_percentile, badge_count
+from db.badge_setting import DEFAULT_BADGE_PRICE, DEFAULT_BADGES_PER_BAG
+from db.storage import connect, describe_profile
+from db.heatmap import BREAKDOWNS, get_year_heatmap
+from db.query import fetch_daily_summary, fetch_weekly_summary, fetch_monthly_summary, fetch_user_by_username
+from db.milestone import milestone_message, milestone_class, fetch_milestone_feed
+from db.search import search_purchases
+from admission import AdmissionGate, admission_required
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this'
-DATABASE = 'oshikatsu.db'
+DATABASE = os.environ.get('OSHI_DATABASE', 'oshikatsu.db')
 SCHEMA_PATH = os.path.join('db', 'schema.sql')
+# コンパイル済みテンプレートの保存先 (同じマシンのワーカーで共有する)
+JINJA_CACHE_DIR = os.environ.get('OSHI_JINJA_CACHE_DIR', os.path.join('instance', 'jinja_cache'))
+# メモの最大文字数
+MEMO_MAX_LENGTH = 200
+# 受付制御の状態などの運用向けAPIを見られるユーザー名 (カンマ区切り)
+ADMIN_USERS = frozenset(u for u in os.environ.get('OSHI_ADMIN_USERS', '').split(',') if u)
+# 書き込みスレッドのコミット待ちの上限 (秒)
+WRITE_TIMEOUT = 10
+
+# 受付制御 (同時実行数, 待ち行列の長さ, 待ち時間の上限[秒])
+# 書き込みと読み込みで枠を分け、書き込みが詰まっても画面表示は別枠で受け付ける
+write_gate = AdmissionGate(
+    'write',
+    max_concurrent=int(os.environ.get('OSHI_WRITE_CONCURRENCY', '8')),
+    max_queue=int(os.environ.get('OSHI_WRITE_QUEUE', '32')),
+    timeout=float(os.environ.get('OSHI_WRITE_DEADLINE', '2.0')),
+)
+read_gate = AdmissionGate(
+    'read',
+    max_concurrent=int(os.environ.get('OSHI_READ_CONCURRENCY', '32')),
+    max_queue=int(os.environ.get('OSHI_READ_QUEUE', '64')),
+    timeout=float(os.environ.get('OSHI_READ_DEADLINE', '1.0')),
+)
 
 # --- データベース接続ヘルパー ---
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+def get_db_connection(user_id=None):
+    """user_id を渡すと、シャーディング有効時はそのユーザーのシャードに接続する"""
+    return connect(resolve_db_path(DATABASE, user_id))
+
+def get_read_connection(user_id=None):
+    """読み込み専用の接続 (書き込みは書き込みスレッドだけが行う)"""
+    return connect(resolve_db_path(DATABASE, user_id), read_only=True)
+
+def get_percentile_of(year, month, metric, value):
+    """全ユーザー中の順位 (value より少ない人の割合, 0〜100) を全シャードのスケッチから求める"""
+    conns = [connect(path, read_only=True) for path in data_db_paths(DATABASE)]
+    try:
+        return get_percentile(conns, year, month, metric, value)
+    finally:
+        for conn in conns:
+            conn.close()
 
 # --- データベース初期化関数 ---
 def init_db_if_needed():
-    """テーブルが存在しない場合、schema.sqlを実行して初期化する"""
-    create_needed = False
-    if not os.path.exists(DATABASE):
-        create_needed = True
-    else:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # usersテーブルがあるか確認
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users';")
-        result = cursor.fetchone()
-        conn.close()
-        create_needed = (result is None)
-
-    if create_needed:
-        print("Initializing database...")
-        if os.path.exists(SCHEMA_PATH):
-            conn = get_db_connection()
-            with open(SCHEMA_PATH, mode='r', encoding='utf-8') as f:
-                conn.executescript(f.read())
+    """
+    各DBファイル (シャードも含む) のスキーマを確認し、必要なときだけ初期化・更新する
+    判定は PRAGMA user_version を読むだけなので、テーブルの有無は調べない
+    """
+    for path in dict.fromkeys([DATABASE] + data_db_paths(DATABASE)):
+        conn = connect(path)
+        try:
+            if ensure_schema(conn, SCHEMA_PATH):
+                print(f"Database initialized. ({path})")
+        finally:
             conn.close()
-            print("Database initialized.")
-        else:
-            print(f"Error: {SCHEMA_PATH} not found. Cannot initialize database.")
 
-# --- 集計更新ヘルパー関数 (新規追加) ---
-def update_summaries(user_id, date_str):
+# --- 起動処理 (アプリケーションファクトリ) ---
+def prewarm(flask_app):
+    """リクエストを受け付ける前に、全テンプレートのコンパイルと書き込みスレッドの起動を済ませる"""
+    for name in flask_app.jinja_env.list_templates():
+        flask_app.jinja_env.get_template(name)
+    for path in data_db_paths(DATABASE):
+        get_writer(path).start()
+
+def create_app(prewarm_caches=None):
     """
-    指定された日付に関連する日次、週次、月次の集計を再計算して更新する
-    date_str: 'YYYY-MM-DD' 形式
+    起動時の準備をまとめて行い、アプリを返す (gunicorn なら 'server:create_app()' で起動)
+    - スキーマ確認は PRAGMA user_version だけで判定
+    - コンパイル済みテンプレートはディスクに保存し、ワーカー間・再起動後も使い回す
+    - prewarm_caches が真なら、テンプレートなどを先に温めてから返す
     """
-    conn = get_db_connection()
-    
-    # 日付オブジェクト変換
+    print(f"Storage profile: {describe_profile()}")
+    init_db_if_needed()
+
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+    if prewarm_caches is None:
+        prewarm_caches = os.environ.get('OSHI_PREWARM', '1') == '1'
+    if prewarm_caches:
+        prewarm(app)
+    return app
+
+# --- 購入入力・集計値の共通処理 ---
+# フォームのカテゴリ名 -> amounts のキー
+CATEGORY_KEYS = {'ドリンク': 'drink', 'スナック': 'snack', 'フード': 'main', 'その他': 'irregular'}
+TIME_PERIODS = ('朝', '昼', '晩')
+
+def parse_purchase_input(date_val, time_period, category, amount_str):
+    """
+    入力値を検証して (正規化した日付, amounts) を返す
+    不正な場合は画面にそのまま出せるメッセージ付きの ValueError
+    (JSON から来た値は文字列とは限らないので、型もここで確かめる)
+    """
+    if not isinstance(date_val, str) or not isinstance(category, str):
+        raise ValueError('入力の形式が正しくありません')
+    # 日付の正規化 (DBは YYYY-MM-DD)
+    date_val = date_val.replace('/', '-')
+    # bool は int の一種なので別に弾く
+    if isinstance(amount_str, bool) or not isinstance(amount_str, (str, int)):
+        raise ValueError('金額は数値で入力してください')
     try:
-        target_date = datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
+        amount = int(amount_str)
     except ValueError:
-        conn.close()
-        return
-
-    # --- 1. 日次集計 (Daily) ---
-    purchases = conn.execute("""
-        SELECT drink_amount, snack_amount, main_dish_amount, irregular_amount
-        FROM purchases
-        WHERE user_id = ? AND purchase_date = ?
-    """, (user_id, date_str)).fetchall()
-    
-    drink_total = sum(p['drink_amount'] for p in purchases)
-    snack_total = sum(p['snack_amount'] for p in purchases)
-    main_total = sum(p['main_dish_amount'] for p in purchases)
-    irr_total = sum(p['irregular_amount'] for p in purchases)
-    daily_total = drink_total + snack_total + main_total + irr_total
-    
-    # REPLACE INTO で更新 (UNIQUE制約を利用して上書き)
-    conn.execute("""
-        INSERT OR REPLACE INTO daily_summaries 
-        (user_id, summary_date, drink_total, snack_total, main_dish_total, irregular_total, daily_total, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
-    """, (user_id, date_str, drink_total, snack_total, main_total, irr_total, daily_total))
-
-    # --- 2. 月次集計 (Monthly) ---
-    year = target_date.year
-    month = target_date.month
-    
-    # SQLiteの日付関数で月ごとの集計
-    monthly_rows = conn.execute("""
-        SELECT drink_amount, snack_amount, main_dish_amount, irregular_amount
-        FROM purchases
-        WHERE user_id = ? AND CAST(strftime('%Y', purchase_date) AS INTEGER) = ? 
-        AND CAST(strftime('%m', purchase_date) AS INTEGER) = ?
-    """, (user_id, year, month)).fetchall()
-    
-    m_drink = sum(p['drink_amount'] for p in monthly_rows)
-    m_snack = sum(p['snack_amount'] for p in monthly_rows)
-    m_main = sum(p['main_dish_amount'] for p in monthly_rows)
-    m_irr = sum(p['irregular_amount'] for p in monthly_rows)
-    m_total = m_drink + m_snack + m_main + m_irr
-    
-    conn.execute("""
-        INSERT OR REPLACE INTO monthly_summaries 
-        (user_id, year, month, drink_total, snack_total, main_dish_total, irregular_total, monthly_total, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
-    """, (user_id, year, month, m_drink, m_snack, m_main, m_irr, m_total))
-
-    # --- 3. 週次集計 (Weekly) ---
-    # 週の開始日(日曜)を計算
-    idx = (target_date.weekday() + 1) % 7
-    sunday = target_date - datetime.timedelta(days=idx)
-    sunday_str = sunday.strftime('%Y-%m-%d')
-    saturday = sunday + datetime.timedelta(days=6)
-    saturday_str = saturday.strftime('%Y-%m-%d')
-    
-    weekly_rows = conn.execute("""
-        SELECT drink_amount, snack_amount, main_dish_amount, irregular_amount
-        FROM purchases
-        WHERE user_id = ? AND purchase_date >= ? AND purchase_date <= ?
-    """, (user_id, sunday_str, saturday_str)).fetchall()
-    
-    w_drink = sum(p['drink_amount'] for p in weekly_rows)
-    w_snack = sum(p['snack_amount'] for p in weekly_rows)
-    w_main = sum(p['main_dish_amount'] for p in weekly_rows)
-    w_irr = sum(p['irregular_amount'] for p in weekly_rows)
-    w_total = w_drink + w_snack + w_main + w_irr
-    
-    conn.execute("""
-        INSERT OR REPLACE INTO weekly_summaries 
-        (user_id, start_date, end_date, drink_total, snack_total, main_dish_total, irregular_total, weekly_total, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
-    """, (user_id, sunday_str, saturday_str, w_drink, w_snack, w_main, w_irr, w_total))
+        raise ValueError('金額は数値で入力してください')
+    if amount < 0:
+        raise ValueError('金額は0以上で入力してください')
+    try:
+        # '2025-3-5' のようなゼロ埋めなしの日付も、保存・集計の前に 'YYYY-MM-DD' にそろえる
+        date_val = datetime.datetime.strptime(date_val, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        raise ValueError('日付の形式が正しくありません')
+    if time_period not in TIME_PERIODS:
+        raise ValueError('時間帯を選択してください')
+    if category not in CATEGORY_KEYS:
+        raise ValueError('カテゴリを選択してください')
 
-    conn.commit()
-    conn.close()
+    # カテゴリ振り分け
+    amounts = {key: 0 for key in CATEGORY_KEYS.values()}
+    amounts[CATEGORY_KEYS[category]] = amount
+    return date_val, amounts
+
+def fetch_totals(conn, user_id, date_str):
+    """date_str の日・その日を含む週・月の合計金額を返す (ホーム画面と /api/insert で共通)"""
+    year, month = int(date_str[:4]), int(date_str[5:7])
+
+    # その日のデータ
+    daily = fetch_daily_summary(
+        conn, user_id, date_str, ('daily_total', 'drink_total', 'snack_total', 'main_dish_total')
+    )
+    # その週のデータ (週の開始日はカレンダー表から引く)
+    weekly = fetch_weekly_summary(conn, user_id, date_str, ('weekly_total',))
+    # その月のデータ
+    monthly = fetch_monthly_summary(conn, user_id, year, month, ('monthly_total',))
+
+    return {
+        'daily_total': daily.daily_total if daily else 0,
+        'drink': daily.drink_total if daily else 0,
+        'snack': daily.snack_total if daily else 0,
+        'main': daily.main_dish_total if daily else 0,
+
+        'weekly_total': weekly.weekly_total if weekly else 0,
+        'monthly_total': monthly.monthly_total if monthly else 0
+    }
+
+class WritePending(Exception):
+    """コミット待ちが WRITE_TIMEOUT を超えたが、書き込みはすでに始まっていて後で保存される"""
+
+def submit_purchase(user_id, date_val, time_period, amounts, memo=""):
+    """
+    購入の追加と集計データの更新を書き込みスレッドに依頼し、コミットを待って purchase_id を返す
+    (ヒートマップのキャッシュは書き込みスレッドがコミット後に捨てる)
+    WRITE_TIMEOUT 以内に終わらない場合:
+    - まだ書き込みが始まっていなければ取り消して TimeoutError (保存されないので再送してよい)
+    - 始まっていれば WritePending (再送すると二重に記録される)
+    """
+    writer = get_writer(resolve_db_path(DATABASE, user_id))
+    future = writer.submit(user_id, date_val, time_period, amounts, memo)
+    try:
+        return future.result(timeout=WRITE_TIMEOUT)
+    except FutureTimeoutError:
+        if future.cancel():
+            raise TimeoutError('混み合っているため保存できませんでした。もう一度お試しください') from None
+        raise WritePending('記録を処理中です。再送せず、しばらくしてから履歴を確認してください') from None
 
 # --- フォームクラス ---
 class SignupForm(FlaskForm):
@@ -143,8 +200,8 @@ class SignupForm(FlaskForm):
     submit = SubmitField('Sign Up')
 
     def validate_username(self, field):
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (field.data,)).fetchone()
+        conn = get_read_connection()
+        user = fetch_user_by_username(conn, field.data, ('user_id',))
         conn.close()
         if user:
             raise ValidationError('This username is already taken.')
@@ -157,6 +214,7 @@ class LoginForm(FlaskForm):
 # --- ルート定義 ---
 
 @app.route('/')
+@admission_required(read_gate)
 def index():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -164,43 +222,11 @@ def index():
     user_id = session['user_id']
     username = session.get('username', 'User')
     
-    conn = get_db_connection()
-    today = datetime.date.today()
-    today_str = today.strftime('%Y-%m-%d')
-
-    # 本日のデータ
-    daily = conn.execute(
-        "SELECT * FROM daily_summaries WHERE user_id = ? AND summary_date = ?",
-        (user_id, today_str)
-    ).fetchone()
-
-    # 今週のデータ
-    idx = (today.weekday() + 1) % 7 
-    sunday = today - datetime.timedelta(days=idx)
-    sunday_str = sunday.strftime('%Y-%m-%d')
-    
-    weekly = conn.execute(
-        "SELECT * FROM weekly_summaries WHERE user_id = ? AND start_date = ?",
-        (user_id, sunday_str)
-    ).fetchone()
-
-    # 今月のデータ
-    monthly = conn.execute(
-        "SELECT * FROM monthly_summaries WHERE user_id = ? AND year = ? AND month = ?",
-        (user_id, today.year, today.month)
-    ).fetchone()
-    
-    conn.close()
-
-    data = {
-        'daily_total': daily['daily_total'] if daily else 0,
-        'drink': daily['drink_total'] if daily else 0,
-        'snack': daily['snack_total'] if daily else 0,
-        'main': daily['main_dish_total'] if daily else 0,
-        
-        'weekly_total': weekly['weekly_total'] if weekly else 0,
-        'monthly_total': monthly['monthly_total'] if monthly else 0
-    }
+    conn = get_read_connection(user_id)
+    try:
+        data = fetch_totals(conn, user_id, datetime.date.today().strftime('%Y-%m-%d'))
+    finally:
+        conn.close()
 
     return render_template('index.html', username=username, data=data)
 
@@ -225,8 +251,8 @@ def signup():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (form.username.data,)).fetchone()
+        conn = get_read_connection()
+        user = fetch_user_by_username(conn, form.username.data, ('user_id', 'username', 'password_hash'))
         conn.close()
         
         if user and check_password_hash(user['password_hash'], form.password.data):
@@ -246,6 +272,7 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/insert', methods=['GET', 'POST'])
+@admission_required(write_gate, methods=('POST',))
 def insert():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -259,33 +286,28 @@ def insert():
         time_period = request.form.get('time_period') # 朝, 昼, 晩
         category = request.form.get('category') # ドリンク, スナック, フード, その他
         amount_str = request.form.get('amount')
+        memo = request.form.get('memo', '').strip()[:MEMO_MAX_LENGTH]
         
         if date_val and amount_str and category:
-            # 日付の正規化 (DBは YYYY-MM-DD)
-            date_val = date_val.replace('/', '-')
-            
             try:
-                amount = int(amount_str)
-            except ValueError:
-                flash('金額は数値で入力してください', 'danger')
+                date_val, amounts = parse_purchase_input(date_val, time_period, category, amount_str)
+            except ValueError as e:
+                flash(str(e), 'danger')
                 return redirect(url_for('insert'))
 
-            # カテゴリ振り分け
-            drink = amount if category == 'ドリンク' else 0
-            snack = amount if category == 'スナック' else 0
-            main = amount if category == 'フード' else 0
-            irr = amount if category == 'その他' else 0
-            
-            conn = get_db_connection()
-            conn.execute("""
-                INSERT INTO purchases (user_id, purchase_date, time_period, drink_amount, snack_amount, main_dish_amount, irregular_amount)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (user_id, date_val, time_period, drink, snack, main, irr))
-            conn.commit()
-            conn.close()
-            
-            # 【重要】集計データの更新
-            update_summaries(user_id, date_val)
+            try:
+                submit_purchase(user_id, date_val, time_period, amounts, memo)
+            except WritePending as e:
+                flash(str(e), 'warning')
+                return redirect(url_for('insert'))
+            except TimeoutError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('insert'))
+            except Exception as e:
+                # 内部の例外メッセージは画面に出さず、ログにだけ残す
+                print(f"Error recording purchase: {e}")
+                flash('記録に失敗しました', 'danger')
+                return redirect(url_for('insert'))
             
             flash('購入データを記録しました！', 'success')
         else:
@@ -295,22 +317,193 @@ def insert():
 
     return render_template('datainsert.html')
 
+@app.route('/api/insert', methods=['POST'])
+@admission_required(write_gate)
+def api_insert():
+    """
+    購入を記録し、更新後の日・週・月の合計をそのまま返す (画面の再読み込みなしで反映する用)
+    フォーム送信 (FormData) と JSON のどちらでも受け付ける
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    user_id = session['user_id']
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = request.form
+    elif not isinstance(payload, dict):
+        return jsonify({'error': '入力の形式が正しくありません'}), 400
+    date_val = payload.get('date')
+    time_period = payload.get('time_period')
+    category = payload.get('category')
+    amount_str = payload.get('amount')
+    memo = payload.get('memo') or ''
+
+    if not (date_val and amount_str is not None and amount_str != '' and category):
+        return jsonify({'error': 'すべての項目を入力してください'}), 400
+    if not isinstance(memo, str):
+        return jsonify({'error': '入力の形式が正しくありません'}), 400
+    memo = memo.strip()[:MEMO_MAX_LENGTH]
+    try:
+        date_val, amounts = parse_purchase_input(date_val, time_period, category, amount_str)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        purchase_id = submit_purchase(user_id, date_val, time_period, amounts, memo)
+    except WritePending as e:
+        # 受け付け済みで後から保存される (合計はまだ反映されていない)
+        return jsonify({'pending': True, 'message': str(e), 'date': date_val}), 202
+    except TimeoutError as e:
+        # 取り消し済みで保存されていないので、再送してよい
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        # 内部の例外メッセージは返さず、ログにだけ残す
+        print(f"Error recording purchase: {e}")
+        return jsonify({'error': '記録に失敗しました'}), 500
+
+    conn = get_read_connection(user_id)
+    try:
+        totals = fetch_totals(conn, user_id, date_val)
+    finally:
+        conn.close()
+
+    return jsonify({
+        'purchase_id': purchase_id,
+        'date': date_val,
+        'totals': totals
+    })
+
+@app.route('/history')
+@admission_required(read_gate)
+def history():
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    conn = get_read_connection(session['user_id'])
+    try:
+        purchases, next_cursor = fetch_purchase_page(
+            conn, session['user_id'], request.args.get('cursor'), request.args.get('limit', type=int)
+        )
+    except ValueError:
+        flash('ページの指定が不正です', 'warning')
+        return redirect(url_for('history'))
+    finally:
+        conn.close()
+
+    return render_template('history.html', purchases=purchases, next_cursor=next_cursor)
+
+@app.route('/api/history')
+@admission_required(read_gate)
+def api_history():
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    conn = get_read_connection(session['user_id'])
+    try:
+        purchases, next_cursor = fetch_purchase_page(
+            conn, session['user_id'], request.args.get('cursor'), request.args.get('limit', type=int)
+        )
+    except ValueError:
+        return jsonify({'error': 'invalid cursor'}), 400
+    finally:
+        conn.close()
+
+    return jsonify({
+        'items': [dict(p) for p in purchases],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/search')
+@admission_required(read_gate)
+def api_search():
+    """
+    メモの全文検索 (?q=語 語 ... は AND 検索)
+    ?from=YYYY-MM-DD&to=YYYY-MM-DD で購入日を絞り、?cursor= で続きを読む
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    try:
+        for value in (date_from, date_to):
+            if value:
+                datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': 'invalid date'}), 400
+
+    conn = get_read_connection(session['user_id'])
+    try:
+        purchases, next_cursor = search_purchases(
+            conn, session['user_id'], request.args.get('q', ''), date_from, date_to,
+            request.args.get('cursor'), request.args.get('limit', type=int)
+        )
+    except ValueError:
+        return jsonify({'error': 'invalid query or cursor'}), 400
+    finally:
+        conn.close()
+
+    return jsonify({
+        'items': [dict(p) for p in purchases],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/heatmap')
+@admission_required(read_gate)
+def api_heatmap():
+    """
+    1年分の日別支出を返す (totals[i] は1月1日から i 日目の合計)
+    ?breakdown=category,time_period で内訳も含める
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    user_id = session['user_id']
+    year = request.args.get('year', datetime.date.today().year, type=int)
+    if not 1900 <= year <= 2100:
+        return jsonify({'error': 'invalid year'}), 400
+    breakdowns = [b for b in request.args.get('breakdown', '').split(',') if b]
+    if any(b not in BREAKDOWNS for b in breakdowns):
+        return jsonify({'error': f"breakdown must be one of: {', '.join(BREAKDOWNS)}"}), 400
+
+    return jsonify(get_year_heatmap(lambda: get_read_connection(user_id), user_id, year, breakdowns))
+
+@app.route('/api/milestones')
+@admission_required(read_gate)
+def api_milestones():
+    """バッジ換算の節目イベントを新しい順に返す (?before=<next_cursor> で続きを読む)"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    before = request.args.get('before', type=int)
+    conn = get_read_connection(session['user_id'])
+    try:
+        events, next_cursor = fetch_milestone_feed(
+            conn, session['user_id'], before, request.args.get('limit', type=int)
+        )
+    finally:
+        conn.close()
+
+    return jsonify({
+        'items': [dict(e) for e in events],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/otaku')
+@admission_required(read_gate)
 def otaku():
     if 'user_id' not in session:
         return redirect(url_for('login'))
     
     user_id = session['user_id']
-    conn = get_db_connection()
+    conn = get_read_connection(user_id)
     
     today = datetime.date.today()
     
     # 月次データの取得
-    monthly = conn.execute(
-        "SELECT monthly_total FROM monthly_summaries WHERE user_id = ? AND year = ? AND month = ?",
-        (user_id, today.year, today.month)
-    ).fetchone()
-    monthly_total = monthly['monthly_total'] if monthly else 0
+    monthly = fetch_monthly_summary(conn, user_id, today.year, today.month, ('monthly_total',))
+    monthly_total = monthly.monthly_total if monthly else 0
     
     # バッジ設定の取得
     settings = conn.execute(
@@ -318,30 +511,43 @@ def otaku():
         (user_id,)
     ).fetchone()
     
+    # 設定行が無いユーザーは、集計・節目イベントと同じ既定値で換算する
     if settings:
         badge_price = settings['badge_price']
         itabag_count = settings['badges_per_bag']
     else:
-        badge_price = 440
-        itabag_count = 40
+        badge_price = DEFAULT_BADGE_PRICE
+        itabag_count = DEFAULT_BADGES_PER_BAG
         
     conn.close()
     
-    # 獲得バッジ数の計算
-    if badge_price > 0:
-        earned_badges = int(monthly_total // badge_price)
-    else:
-        earned_badges = 0
+    # 獲得バッジ数の計算 (/api/milestones の節目と同じ規則)
+    earned_badges = badge_count(monthly_total, badge_price)
     
+    # 全ユーザー中の位置 (上位何%か)
+    percentile = get_percentile_of(today.year, today.month, 'monthly_total', monthly_total)
+    top_percent = None if percentile is None else max(1, round(100 - percentile))
+
     data = {
         'monthly_total': monthly_total,
+        'top_percent': top_percent,
         'badge_price': badge_price,
         'earned_badges': earned_badges,
-        'itabag_count': itabag_count
+        'itabag_count': itabag_count,
+        'message': milestone_message(earned_badges),
+        'message_class': milestone_class(earned_badges)
     }
     
     return render_template('otaku.html', data=data)
 
+@app.route('/api/metrics/admission')
+def admission_metrics():
+    """受付制御の状態 (処理中・待ち行列・断った件数など)。OSHI_ADMIN_USERS のユーザーだけが見られる"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'login required'}), 401
+    if session.get('username') not in ADMIN_USERS:
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({gate.name: gate.snapshot() for gate in (write_gate, read_gate)})
+
 if __name__ == '__main__':
-    init_db_if_needed()
-    app.run(debug=True, port=8100)
\ No newline at end of file
+    create_app().run(debug=True, port=8100)
\ No newline at end of file
@@ -73,4 +73,75 @@ document.addEventListener('DOMContentLoaded', () => {
             palette.classList.remove('show');
         }
     });
-});
\ No newline at end of file
+});
+
+/**
+ * 入力フォームを非同期で送信し、返ってきた日・週・月の合計を画面に反映する
+ * (ページ遷移なしで続けて入力できる。fetch が使えない環境では通常の送信のまま)
+ */
+function setupAjaxInsert() {
+    const form = document.getElementById('insert-form');
+    if (!form || !window.fetch) return;
+
+    form.addEventListener('submit', async (event) => {
+        event.preventDefault();
+        const submitBtn = form.querySelector('[type="submit"]');
+        submitBtn.disabled = true;
+
+        try {
+            const response = await fetch(form.dataset.apiUrl, {
+                method: 'POST',
+                body: new FormData(form),
+                headers: { 'Accept': 'application/json' }
+            });
+            const result = await response.json();
+
+            if (!response.ok) {
+                // 混雑時 (503) は Retry-After の秒数を案内する
+                const retryAfter = response.headers.get('Retry-After');
+                const message = result.error === 'server busy' && retryAfter
+                    ? `混雑しています。${retryAfter}秒ほどしてから再度お試しください`
+                    : (result.error || '記録に失敗しました');
+                showInsertResult(message, null, true);
+                return;
+            }
+
+            // 202 (pending) は受け付け済みで後から保存される。合計はまだ変わらないので表示しない
+            const message = result.pending ? result.message : '購入データを記録しました！';
+            showInsertResult(message, result.pending ? null : result.totals, false);
+            // 続けて入力できるよう金額とメモだけ空にする (日付・時間帯・カテゴリは残す)
+            const amountInput = document.getElementById('amount-input');
+            amountInput.value = '';
+            const memoInput = form.querySelector('[name="memo"]');
+            if (memoInput) memoInput.value = '';
+            amountInput.focus();
+        } catch (error) {
+            showInsertResult('通信に失敗しました', null, true);
+        } finally {
+            submitBtn.disabled = false;
+        }
+    });
+}
+
+/**
+ * 非同期登録の結果を表示する
+ * @param {string} message - 表示するメッセージ
+ * @param {Object|null} totals - /api/insert が返した合計 (エラー時は null)
+ * @param {boolean} isError - エラー表示にするかどうか
+ */
+function showInsertResult(message, totals, isError) {
+    const box = document.getElementById('insert-result');
+    const messageEl = document.getElementById('insert-message');
+    box.hidden = false;
+    messageEl.textContent = message;
+    messageEl.classList.toggle('text-danger', isError);
+    messageEl.classList.toggle('text-success', !isError);
+
+    if (totals) {
+        document.getElementById('total-daily').textContent = totals.daily_total.toLocaleString();
+        document.getElementById('total-weekly').textContent = totals.weekly_total.toLocaleString();
+        document.getElementById('total-monthly').textContent = totals.monthly_total.toLocaleString();
+    }
+}
+
+document.addEventListener('DOMContentLoaded', setupAjaxInsert);